@@ -0,0 +1,169 @@
+# Sound playback that never blocks the bot.
+# Sounds are read into memory once as PCM, and a SoundPlayer hands them to an
+# audio backend from its own thread through a bounded queue, so a chat
+# command only ever queues a sound. Backends are plain objects with a
+# play(sound) method that returns once the sound has finished.
+import io
+import os
+import queue
+import threading
+import wave
+from time import sleep
+
+QUEUE_SIZE = 8 # sounds waiting to play before new ones are dropped
+
+
+class Sound(object):
+    """ A WAV file held in memory as PCM frames """
+
+    def __init__(self, name, frames, channels, sample_width, rate):
+        self._name = name
+        self._frames = frames
+        self._channels = channels
+        self._sample_width = sample_width # bytes per sample
+        self._rate = rate
+
+    @classmethod
+    def from_file(cls, name, path):
+        """ (Sound) The sound in the WAV file at path, raising wave.Error or OSError if it can't be read """
+        with wave.open(path, 'rb') as wav:
+            return cls(name, wav.readframes(wav.getnframes()), wav.getnchannels(), wav.getsampwidth(),
+                       wav.getframerate())
+
+    def get_name(self):
+        return self._name
+
+    def get_frames(self):
+        """ (bytes) The raw PCM frames """
+        return self._frames
+
+    def get_format(self):
+        """ (Tuple<int, int, int>) Channels, bytes per sample and frames per second """
+        return self._channels, self._sample_width, self._rate
+
+    def get_duration(self):
+        """ (float) Length in seconds """
+        return len(self._frames) / (self._channels * self._sample_width * self._rate)
+
+    def to_wav(self):
+        """ (bytes) The sound as a complete WAV file """
+        data = io.BytesIO()
+        with wave.open(data, 'wb') as wav:
+            wav.setnchannels(self._channels)
+            wav.setsampwidth(self._sample_width)
+            wav.setframerate(self._rate)
+            wav.writeframes(self._frames)
+        return data.getvalue()
+
+
+class NullBackend(object):
+    """ Plays nothing, taking as long as the sound would (or no time at all) and remembering what was played """
+
+    def __init__(self, realtime=True):
+        self._realtime = realtime
+        self._played = []
+
+    def play(self, sound):
+        self._played.append(sound.get_name())
+        if self._realtime:
+            sleep(sound.get_duration())
+
+    def get_played(self):
+        """ (List<str>) Names of the sounds played so far """
+        return self._played
+
+
+class FileBackend(object):
+    """ Writes each sound played to a numbered WAV file in folder instead of a speaker """
+
+    def __init__(self, folder):
+        self._folder = folder
+        self._count = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def play(self, sound):
+        self._count += 1
+        path = os.path.join(self._folder, f'{self._count:05d}_{sound.get_name()}.wav')
+        with open(path, 'wb') as sound_file:
+            sound_file.write(sound.to_wav())
+
+
+class WinsoundBackend(object):
+    """ Plays sounds on Windows straight from memory """
+
+    def __init__(self):
+        import winsound
+        self._winsound = winsound
+
+    def play(self, sound):
+        # the WAV bytes only live while the sound plays, Sound already holds the PCM
+        # SND_MEMORY can't be asynchronous, which is fine on the player's thread
+        self._winsound.PlaySound(sound.to_wav(), self._winsound.SND_MEMORY)
+
+
+def default_backend():
+    """ A WinsoundBackend on Windows, otherwise a NullBackend """
+    try:
+        return WinsoundBackend()
+    except ImportError:
+        return NullBackend()
+
+
+class SoundPlayer(object):
+    """ Plays sounds one after another on a background thread.
+
+    play only ever puts the sound on a bounded queue, so it is safe to call
+    from the event loop. When queue_size sounds are already waiting the new
+    one is dropped and counted, rather than piling up or blocking. A backend
+    that raises doesn't stop the thread, the error is counted instead.
+    """
+
+    def __init__(self, backend=None, queue_size=QUEUE_SIZE):
+        self._backend = default_backend() if backend is None else backend
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stats = dict.fromkeys(('queued', 'played', 'dropped', 'failed'), 0)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def get_backend(self):
+        return self._backend
+
+    def play(self, sound):
+        """ (bool) Queues sound to play, returning False if it was dropped because the queue is full """
+        try:
+            self._queue.put_nowait(sound)
+        except queue.Full:
+            self._stats['dropped'] += 1
+            return False
+        self._stats['queued'] += 1
+        return True
+
+    def _run(self):
+        while True:
+            sound = self._queue.get()
+            if sound is None:
+                self._queue.task_done()
+                return
+            try:
+                self._backend.play(sound)
+                self._stats['played'] += 1
+            except Exception as error:
+                print(f'Could not play {sound.get_name()}: {error}')
+                self._stats['failed'] += 1
+            finally:
+                self._queue.task_done()
+
+    def wait(self):
+        """ Waits for every queued sound to finish playing """
+        self._queue.join()
+
+    def close(self):
+        """ Lets queued sounds finish, then stops the thread """
+        self._queue.put(None)
+        self._thread.join()
+
+    def get_stats(self):
+        """ (Dict<str, int>) Sounds queued, played, dropped because the queue was full and failed, and waiting """
+        stats = dict(self._stats)
+        stats['waiting'] = self._queue.qsize()
+        return stats
@@ -0,0 +1,175 @@
+# Parallel analysis on top of the engine.
+# The root moves of a position are split across a process pool. Each worker
+# gets the position as the 32 bytes of Board.to_bytes, searches its share of
+# the moves and reports a score and best line for every depth it finished.
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from engine import Engine, MATE, MAX_PLY
+from model import *
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+WORKER_TABLE_SIZE = 1 << 16
+
+
+def search_moves(data, side, moves, budget, max_depth, table_size=WORKER_TABLE_SIZE):
+    """ (Dict) Searches moves of the position packed in data, run inside a worker process """
+    board = Board.from_bytes(data)
+    engine = Engine(table_size)
+
+    start = perf_counter()
+    move, score, _ = engine.search(board, side, budget, max_depth, moves=moves)
+    elapsed = perf_counter() - start
+
+    iterations = [(score, move, engine.get_line(board, side, move)) for _, score, move in engine.get_iterations()]
+    return {
+        'pid': os.getpid(),
+        'iterations': iterations,
+        'fallback': (score, move), # the engine's answer, even if depth 1 didn't finish
+        'nodes': engine.get_nodes(),
+        'elapsed': elapsed,
+    }
+
+
+class Analysis(object):
+    """ One position being searched in the background by a ParallelEngine.
+
+    Nothing here blocks until get_result is called, so the Tk app can poll
+    is_done from an after callback and the bot can await
+    asyncio.wrap_future on each of get_futures.
+    """
+
+    def __init__(self, futures, fallback, score=None):
+        self._futures = futures
+        self._fallback = fallback # answer if no worker finishes a depth, or there are no moves
+        self._score = score
+        self._started = perf_counter()
+        self._finished = None if futures else self._started
+
+    def get_futures(self):
+        """ (List<Future>) The pending worker searches """
+        return self._futures
+
+    def is_done(self):
+        """ (bool) True once every worker has reported back """
+        done = all(future.done() for future in self._futures)
+        if done and self._finished is None:
+            self._finished = perf_counter()
+        return done
+
+    def add_done_callback(self, callback):
+        """ Calls callback(analysis) from a pool thread once every worker has reported back """
+        remaining = [len(self._futures)]
+
+        def finished(_):
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                callback(self)
+
+        if not self._futures:
+            callback(self)
+        for future in self._futures:
+            future.add_done_callback(finished)
+
+    def cancel(self):
+        """ Drops worker searches that have not started yet """
+        for future in self._futures:
+            future.cancel()
+
+    def _reports(self):
+        return [future.result() for future in self._futures if not future.cancelled()]
+
+    def get_result(self):
+        """ (Tuple<Tuple, int, int, List<Tuple>>) The best move, its score, the depth reached and the best line.
+
+        Blocks until every worker is done. Workers may reach different depths,
+        so moves are compared at the deepest depth all of them finished.
+        """
+        reports = self._reports()
+        self.is_done()
+
+        depth = min((len(report['iterations']) for report in reports), default=0)
+        if depth == 0:
+            if reports:
+                self._score, self._fallback = max((report['fallback'] for report in reports),
+                                                  key=lambda found: found[0])
+            return self._fallback, self._score, 0, [] if self._fallback is None else [self._fallback]
+
+        score, move, line = max((report['iterations'][depth - 1] for report in reports), key=lambda found: found[0])
+        return move, score, depth, line
+
+    def get_stats(self):
+        """ (Dict) Total nodes, wall time, overall and per worker process nodes per second """
+        reports = self._reports()
+        self.is_done()
+
+        workers = {}
+        for report in reports:
+            nodes, elapsed = workers.get(report['pid'], (0, 0.0))
+            workers[report['pid']] = (nodes + report['nodes'], elapsed + report['elapsed'])
+
+        nodes = sum(report['nodes'] for report in reports)
+        elapsed = self._finished - self._started
+        return {
+            'nodes': nodes,
+            'elapsed': elapsed,
+            'nodes_per_second': nodes / elapsed if elapsed else 0,
+            'workers': {pid: nodes / elapsed if elapsed else 0 for pid, (nodes, elapsed) in workers.items()},
+        }
+
+
+class ParallelEngine(object):
+    """ Splits the root moves of a search across a pool of worker processes.
+
+    Every worker runs its own iterative deepening Engine over a share of the
+    moves for the whole budget, so analysis uses every core while the calling
+    process only waits on futures.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, table_size=WORKER_TABLE_SIZE):
+        self._workers = workers
+        self._table_size = table_size
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        self._futures = set() # searches not yet finished, for shutdown to cancel
+
+    def analyse(self, board, side, budget, max_depth=MAX_PLY):
+        """ (Analysis) Starts searching board for side in the background and returns straight away """
+        moves = board.legal_moves(side)
+        if not moves:
+            return Analysis([], None, -MATE if board.is_in_check(side) else 0)
+
+        data = board.to_bytes()
+        futures = []
+        for worker in range(min(self._workers, len(moves))):
+            share = moves[worker::self._workers]
+            future = self._pool.submit(search_moves, data, side, share, budget, max_depth, self._table_size)
+            self._futures.add(future)
+            future.add_done_callback(self._futures.discard)
+            futures.append(future)
+        return Analysis(futures, moves[0])
+
+    def search(self, board, side, budget, max_depth=MAX_PLY):
+        """ (Tuple<Tuple, int, int>) Same as Engine.search, but using every worker """
+        move, score, depth, _ = self.analyse(board, side, budget, max_depth).get_result()
+        return move, score, depth
+
+    def shutdown(self):
+        """ Stops the worker processes, dropping searches that have not started """
+        # shutdown only takes cancel_futures from Python 3.9
+        for future in list(self._futures):
+            future.cancel()
+        self._pool.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    engine = ParallelEngine()
+    board = Board.from_fen(START_FEN)
+    analysis = engine.analyse(board, board.get_turn(), budget=2)
+    move, score, depth, line = analysis.get_result()
+    stats = analysis.get_stats()
+    print(f'best {move} score {score} depth {depth} line {line}')
+    print(f'nodes {stats["nodes"]} in {stats["elapsed"]:.2f}s, {stats["nodes_per_second"]:.0f} nodes/s')
+    for pid, rate in stats['workers'].items():
+        print(f'  worker {pid}: {rate:.0f} nodes/s')
+    engine.shutdown()
@@ -0,0 +1,143 @@
+# Opening books: known positions mapped to weighted moves.
+# A book is a sorted file of fixed size entries that is memory mapped and
+# binary searched, so opening one costs nothing and lookups only touch the
+# few pages they need. build_book compiles one from PGN archives.
+import argparse
+import mmap
+import random
+import struct
+
+from model import *
+from recorder import decode_move, encode_move, read_games
+
+BOOK_MAGIC = b'BOOK'
+# the magic and the zobrist seed the keys were made with
+HEADER_FORMAT = struct.Struct('<4sQ4x')
+# zobrist key, recorder move word and weight, sorted by key
+ENTRY_FORMAT = struct.Struct('<QHH')
+MAX_WEIGHT = 0xffff
+
+BOOK_PLIES = 20 # how deep into each game positions are added
+
+
+class OpeningBook(object):
+    """ A read only opening book memory mapped from a file written by build_book """
+
+    def __init__(self, path):
+        with open(path, 'rb') as book_file:
+            self._map = mmap.mmap(book_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, seed = HEADER_FORMAT.unpack_from(self._map)
+        if magic != BOOK_MAGIC or seed != ZOBRIST_SEED:
+            self._map.close()
+            raise ValueError(f'{path} is not an opening book for these zobrist keys')
+        self._size = (len(self._map) - HEADER_FORMAT.size) // ENTRY_FORMAT.size
+
+    def __len__(self):
+        return self._size
+
+    def _key_at(self, entry):
+        return ENTRY_FORMAT.unpack_from(self._map, HEADER_FORMAT.size + entry * ENTRY_FORMAT.size)[0]
+
+    def get_moves(self, board, side=None):
+        """ (List<Tuple<Tuple, int>>) The book moves for side (default the side to move) and their weights """
+        if side is None:
+            side = board.get_turn()
+        key = board.get_hash()
+        if side != board.get_turn():
+            key ^= ZOBRIST_TURN
+
+        # binary search for the first entry with this key
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        result = []
+        legal = None
+        for entry in range(low, self._size):
+            found, word, weight = ENTRY_FORMAT.unpack_from(self._map, HEADER_FORMAT.size + entry * ENTRY_FORMAT.size)
+            if found != key:
+                break
+
+            # a key collision could suggest nonsense, so only legal moves are trusted
+            if legal is None:
+                legal = board.legal_moves(side)
+            move = decode_move(word)
+            if move in legal:
+                result.append((move, weight))
+        return result
+
+    def choose(self, board, side=None, rng=random):
+        """ (Tuple) A book move picked at random in proportion to its weight, or None out of book """
+        moves = self.get_moves(board, side)
+        if not moves:
+            return None
+        return rng.choices([move for move, _ in moves], weights=[weight for _, weight in moves])[0]
+
+    def close(self):
+        self._map.close()
+
+
+def build_book(paths, output, plies=BOOK_PLIES, min_count=1):
+    """ (int) Writes a book of the first plies moves of every game in the PGN archives in paths.
+
+    A move's weight is how many games played it from that position, and
+    moves played fewer than min_count times are left out. Returns the number
+    of entries written.
+    """
+    counts = {}
+    for path in paths:
+        for game in read_games(path):
+            key = Board.from_fen(game.get_start()).get_hash()
+            try:
+                for ply, (move, board) in enumerate(game.replay()):
+                    if ply >= plies:
+                        break
+                    counts[key, encode_move(move)] = counts.get((key, encode_move(move)), 0) + 1
+                    key = board.get_hash()
+            except ValueError:
+                # keep the moves before the mistake
+                continue
+
+    entries = sorted(((key, word, min(count, MAX_WEIGHT)) for (key, word), count in counts.items()
+                      if count >= min_count), key=lambda entry: (entry[0], -entry[2]))
+    with open(output, 'wb') as book_file:
+        book_file.write(HEADER_FORMAT.pack(BOOK_MAGIC, ZOBRIST_SEED))
+        for entry in entries:
+            book_file.write(ENTRY_FORMAT.pack(*entry))
+    return len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or probe opening books')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help='compile a book from PGN archives')
+    build.add_argument('output')
+    build.add_argument('archives', nargs='+')
+    build.add_argument('--plies', type=int, default=BOOK_PLIES)
+    build.add_argument('--min-count', type=int, default=1)
+
+    probe = commands.add_parser('probe', help='list the book moves of a position')
+    probe.add_argument('book')
+    probe.add_argument('--fen', default=START_FEN)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        entries = build_book(args.archives, args.output, args.plies, args.min_count)
+        print(f'{entries} entries written to {args.output}')
+        return
+
+    book = OpeningBook(args.book)
+    board = Board.from_fen(args.fen)
+    for move, weight in book.get_moves(board):
+        print(board.move_to_san(move), weight)
+    book.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,8 +9,11 @@ def main():
 
 class ChessApp(object):
 
+    INCREMENT = 2
+
     def __init__(self, master):
         super().__init__()
+        self._master = master
 
         board = Board.load('default_board.txt')
         #board.display()
@@ -18,7 +21,10 @@ class ChessApp(object):
         player1 = Player("harry", 60)
         player2 = Player("chat", 60)
 
-        self._game = ChessGame(player1, player2, board=board)
+        clock = ChessClock(player1, player2, increment=self.INCREMENT)
+        self._game = ChessGame(player1, player2, board=board, clock=clock)
+        self._flag_wakeup = None
+        self._clock_refresh = None
         self._view = ImageChessView(master)
         self._view.pack(side=tk.TOP)
 
@@ -29,6 +35,7 @@ class ChessApp(object):
 
         self._selected_square = None
         self._view.draw_board(board)
+        self.update_info(None)
 
     def left_click(self, e):
         pixel = e.x, e.y
@@ -43,14 +50,12 @@ class ChessApp(object):
 
         # if we've already clicked somewhere
         else:
-            old_piece = board.get_piece(self._selected_square)
-
             if position == self._selected_square:
                 self._selected_square = None
                 self._view.draw_board(board)
 
             # if valid move
-            elif position in old_piece.possible_moves(self._selected_square, board):
+            elif position in self._game.get_targets(self._selected_square):
                 side = self._game.get_turn()
                 # make the move
                 self._game.attempt_move(side, self._selected_square, position)
@@ -73,11 +78,43 @@ class ChessApp(object):
     def update_info(self, position):
         self._info.set_turn(self._game.get_turn())
         self._info.set_selected(self._selected_square)
+        self.refresh_clock()
+        self.schedule_flag()
+
+    def refresh_clock(self):
+        # redraw the clock as the running side's time ticks over, about once a second
+        if self._clock_refresh is not None:
+            self._master.after_cancel(self._clock_refresh)
+            self._clock_refresh = None
+
+        clock = self._game.get_clock()
+        self._info.set_clock(clock)
+        side = clock.get_running()
+        if side is not None:
+            milliseconds = int(clock.get_remaining(side) % 1 * 1000) + 1
+            self._clock_refresh = self._master.after(milliseconds, self.refresh_clock)
+
+    def schedule_flag(self):
+        # the only timer is one wakeup for when the side to move runs out
+        if self._flag_wakeup is not None:
+            self._master.after_cancel(self._flag_wakeup)
+            self._flag_wakeup = None
+
+        seconds = self._game.get_clock().get_time_to_flag()
+        if seconds is not None:
+            self._flag_wakeup = self._master.after(int(seconds * 1000) + 1, self.flag)
+
+    def flag(self):
+        self._flag_wakeup = None
+        side = self._game.get_turn()
+        if self._game.has_flagged(side):
+            self._game.get_clock().stop()
+            self._game.end('0-1' if side == WHITE else '1-0')
+        self.update_info(self._selected_square)
 
     def highlight_possible_moves(self, piece, position, board):
-        self._view.draw_board(board)
-        possible_moves = piece.possible_moves(position, board)
-        self._view.highlight_squares(possible_moves, board)
+        possible_moves = self._game.get_targets(position)
+        self._view.draw_board(board, highlighted=possible_moves)
 
 
 
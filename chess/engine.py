@@ -0,0 +1,411 @@
+# Alpha-beta search engine built on the chess model.
+# Used to suggest moves, play the bot side or sanity check chat's choices.
+from time import monotonic
+
+from model import *
+
+PIECE_VALUES = (100, 320, 330, 500, 900, 0)
+
+MATE = 100000
+INFINITY = 1000000
+MAX_PLY = 64
+
+# fraction of a player's remaining time spent on one move
+MOVES_TO_GO = 30
+MIN_BUDGET = 0.05
+CHECK_EVERY = 64 # nodes between deadline checks, a few milliseconds at this engine's speed
+
+# transposition table entry flags
+EXACT, LOWER, UPPER = range(3)
+
+# piece square tables from white's point of view, written with rank 8 at the top
+_PAWN_TABLE = (
+    0, 0, 0, 0, 0, 0, 0, 0,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    10, 10, 20, 30, 30, 20, 10, 10,
+    5, 5, 10, 25, 25, 10, 5, 5,
+    0, 0, 0, 20, 20, 0, 0, 0,
+    5, -5, -10, 0, 0, -10, -5, 5,
+    5, 10, 10, -20, -20, 10, 10, 5,
+    0, 0, 0, 0, 0, 0, 0, 0,
+)
+_KNIGHT_TABLE = (
+    -50, -40, -30, -30, -30, -30, -40, -50,
+    -40, -20, 0, 0, 0, 0, -20, -40,
+    -30, 0, 10, 15, 15, 10, 0, -30,
+    -30, 5, 15, 20, 20, 15, 5, -30,
+    -30, 0, 15, 20, 20, 15, 0, -30,
+    -30, 5, 10, 15, 15, 10, 5, -30,
+    -40, -20, 0, 5, 5, 0, -20, -40,
+    -50, -40, -30, -30, -30, -30, -40, -50,
+)
+_BISHOP_TABLE = (
+    -20, -10, -10, -10, -10, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 10, 10, 5, 0, -10,
+    -10, 5, 5, 10, 10, 5, 5, -10,
+    -10, 0, 10, 10, 10, 10, 0, -10,
+    -10, 10, 10, 10, 10, 10, 10, -10,
+    -10, 5, 0, 0, 0, 0, 5, -10,
+    -20, -10, -10, -10, -10, -10, -10, -20,
+)
+_ROOK_TABLE = (
+    0, 0, 0, 0, 0, 0, 0, 0,
+    5, 10, 10, 10, 10, 10, 10, 5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    0, 0, 0, 5, 5, 0, 0, 0,
+)
+_QUEEN_TABLE = (
+    -20, -10, -10, -5, -5, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 5, 5, 5, 0, -10,
+    -5, 0, 5, 5, 5, 5, 0, -5,
+    0, 0, 5, 5, 5, 5, 0, -5,
+    -10, 5, 5, 5, 5, 5, 0, -10,
+    -10, 0, 5, 0, 0, 0, 0, -10,
+    -20, -10, -10, -5, -5, -10, -10, -20,
+)
+_KING_TABLE = (
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -20, -30, -30, -40, -40, -30, -30, -20,
+    -10, -20, -20, -20, -20, -20, -20, -10,
+    20, 20, 0, 0, 0, 0, 20, 20,
+    20, 30, 10, 0, 0, 10, 30, 20,
+)
+
+
+def square_values(kind, table):
+    """ (Tuple<Tuple<int>>) Piece value plus table bonus for kind on each square index, per side """
+    white = tuple(PIECE_VALUES[kind] + table[(GRID_SIZE - 1 - index // GRID_SIZE) * GRID_SIZE + index % GRID_SIZE]
+                  for index in range(GRID_SIZE ** 2))
+    # black sees the board upside down
+    black = tuple(white[(GRID_SIZE - 1 - index // GRID_SIZE) * GRID_SIZE + index % GRID_SIZE]
+                  for index in range(GRID_SIZE ** 2))
+    return white, black
+
+
+SQUARE_VALUES = tuple(square_values(kind, table) for kind, table in (
+    (PAWN, _PAWN_TABLE), (KNIGHT, _KNIGHT_TABLE), (BISHOP, _BISHOP_TABLE),
+    (ROOK, _ROOK_TABLE), (QUEEN, _QUEEN_TABLE), (KING, _KING_TABLE),
+))
+
+
+class SearchTimeout(Exception):
+    """ Raised inside the search once the deadline for a move has passed """
+    pass
+
+
+def evaluate(board, side):
+    """ (int) Static score of board in centipawns from side's point of view """
+    score = 0
+    for kind in range(KINDS):
+        for owner, sign in ((WHITE, 1), (BLACK, -1)):
+            values = SQUARE_VALUES[kind][owner]
+            pieces = board.get_bitboard(owner, kind)
+            while pieces:
+                bit = pieces & -pieces
+                pieces ^= bit
+                score += sign * values[bit.bit_length() - 1]
+    return score if side == WHITE else -score
+
+
+def kind_on(board, side, index):
+    """ (int) The kind of side's piece on index, or None if it has none there """
+    if not board.get_occupancy(side) >> index & 1:
+        return None
+    for kind in range(KINDS):
+        if board.get_bitboard(side, kind) >> index & 1:
+            return kind
+
+
+class Engine(object):
+    """ Iterative deepening alpha-beta search with quiescence.
+
+    Moves are ordered by the transposition table move, then captures by
+    most valuable victim / least valuable attacker, then killer moves and
+    finally the history heuristic. The search checks its deadline every
+    CHECK_EVERY nodes and before each root move, and falls back to the best
+    move of the deepest finished iteration, so it always answers on time.
+    Until depth 1 finishes the answer is the move with the best static
+    evaluation once played, counting a piece moved onto an attacked square
+    as lost.
+    """
+
+    def __init__(self, table_size=1 << 18):
+        self._table = TranspositionTable(table_size)
+        self._killers = [[None, None] for _ in range(MAX_PLY)]
+        self._history = {}
+        self._nodes = 0
+        self._deadline = None
+        self._iterations = []
+
+    def get_nodes(self):
+        """ (int) Nodes visited by the last search """
+        return self._nodes
+
+    def get_iterations(self):
+        """ (List<Tuple<int, int, Tuple>>) The depth, score and best move of each finished iteration of the last search """
+        return self._iterations
+
+    @staticmethod
+    def get_budget(time_left):
+        """ (float) Seconds to spend on a move given the seconds left on the clock """
+        return max(MIN_BUDGET, time_left / MOVES_TO_GO)
+
+    def suggest(self, game, max_depth=MAX_PLY):
+        """ (Tuple) The move the engine would play in game for the side to move (a book move if the game has one), or None """
+        side = game.get_turn()
+        move = game.get_book_move(side)
+        if move is not None:
+            return move
+
+        budget = self.get_budget(game.get_time_left(side))
+        return self.search(game.get_board(), side, budget, max_depth)[0]
+
+    def search(self, board, side, budget, max_depth=MAX_PLY, moves=None):
+        """ (Tuple<Tuple, int, int>) The best move for side, its score and the depth reached.
+
+        Searches a copy of board so the caller's board is never touched. If
+        moves is given only those root moves are considered. The move is None
+        only when side has no legal moves.
+        """
+        board = board.copy()
+        self._deadline = monotonic() + budget
+        self._nodes = 0
+        self._killers = [[None, None] for _ in range(MAX_PLY)]
+        self._history.clear()
+        self._iterations = []
+
+        legal = board.legal_moves(side)
+        moves = legal if moves is None else [move for move in legal if move in moves]
+        if not moves:
+            return None, self._terminal_score(board, side, 0), 0
+
+        best_score, best_move = self._static_best(board, side, moves)
+        reached = 0
+        for depth in range(1, max_depth + 1):
+            try:
+                score, move = self._root(board, side, depth, moves)
+            except SearchTimeout:
+                break
+            best_move, best_score, reached = move, score, depth
+            self._iterations.append((depth, score, move))
+
+            # nothing left to find once a forced mate is seen
+            if abs(score) >= MATE - MAX_PLY:
+                break
+
+        return best_move, best_score, reached
+
+    def get_line(self, board, side, move, length=MAX_PLY):
+        """ (List<Tuple>) move followed by the best replies the transposition table remembers """
+        board = board.copy()
+        line = []
+        seen = set()
+        while move is not None and len(line) < length and board.get_hash() not in seen:
+            seen.add(board.get_hash())
+            board.make(*move)
+            line.append(move)
+            side = 1 - side
+
+            # entries can be overwritten or collide, so only follow legal moves
+            move = self._table_move(board)
+            if move not in board.legal_moves(side):
+                break
+        return line
+
+    def _static_best(self, board, side, moves):
+        # (score, move) of the move leaving side best off by evaluate, ties going to the best ordered
+        best_score, best_move = -INFINITY, None
+        for move in self._order(board, side, moves, 0, None):
+            board.make(*move)
+            if board.legal_moves(1 - side):
+                score = -evaluate(board, 1 - side)
+                to_index = Board.position_to_index(move[1])
+                if board.is_square_attacked(move[1], 1 - side):
+                    score -= PIECE_VALUES[kind_on(board, side, to_index)]
+            else:
+                score = -self._terminal_score(board, 1 - side, 1)
+            board.unmake()
+            if score > best_score:
+                best_score, best_move = score, move
+        return best_score, best_move
+
+    def _root(self, board, side, depth, moves):
+        alpha, beta = -INFINITY, INFINITY
+        best_move = None
+        for move in self._order(board, side, moves, 0, self._table_move(board)):
+            # each root move can take a while, so the deadline is checked before every one
+            if monotonic() > self._deadline:
+                raise SearchTimeout()
+            board.make(*move)
+            try:
+                score = -self._negamax(board, 1 - side, depth - 1, -beta, -alpha, 1)
+            finally:
+                board.unmake()
+
+            if score > alpha:
+                alpha, best_move = score, move
+
+        self._table.store(board.get_hash(), (depth, alpha, EXACT, best_move), depth)
+        return alpha, best_move
+
+    def _tick(self):
+        self._nodes += 1
+        if self._nodes % CHECK_EVERY == 0 and monotonic() > self._deadline:
+            raise SearchTimeout()
+
+    def _terminal_score(self, board, side, ply):
+        # mated sooner is worse, stalemate is a draw
+        return -MATE + ply if board.is_in_check(side) else 0
+
+    def _table_move(self, board):
+        entry = self._table.get(board.get_hash())
+        return None if entry is None else entry[3]
+
+    def _negamax(self, board, side, depth, alpha, beta, ply):
+        self._tick()
+
+        if ply > 0 and board.count_repetitions() > 1:
+            return 0
+
+        key = board.get_hash()
+        entry = self._table.get(key)
+        table_move = None
+        if entry is not None:
+            entry_depth, score, flag, table_move = entry
+            if entry_depth >= depth:
+                # mate scores are stored relative to the node, not the root
+                if score >= MATE - MAX_PLY:
+                    score -= ply
+                elif score <= -MATE + MAX_PLY:
+                    score += ply
+
+                if flag == EXACT:
+                    return score
+                if flag == LOWER and score >= beta:
+                    return score
+                if flag == UPPER and score <= alpha:
+                    return score
+
+        if depth <= 0 or ply >= MAX_PLY - 1:
+            return self._quiescence(board, side, alpha, beta, ply)
+
+        moves = board.legal_moves(side)
+        if not moves:
+            return self._terminal_score(board, side, ply)
+
+        original_alpha = alpha
+        best_score, best_move = -INFINITY, None
+        for move in self._order(board, side, moves, ply, table_move):
+            board.make(*move)
+            try:
+                score = -self._negamax(board, 1 - side, depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                board.unmake()
+
+            if score > best_score:
+                best_score, best_move = score, move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if not self._is_capture(board, side, move):
+                    self._remember_cutoff(move, depth, ply)
+                break
+
+        if best_score <= original_alpha:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+
+        stored = best_score
+        if stored >= MATE - MAX_PLY:
+            stored += ply
+        elif stored <= -MATE + MAX_PLY:
+            stored -= ply
+        self._table.store(key, (depth, stored, flag, best_move), depth)
+
+        return best_score
+
+    def _quiescence(self, board, side, alpha, beta, ply):
+        self._tick()
+
+        in_check = board.is_in_check(side)
+        moves = board.legal_moves(side)
+        if not moves:
+            return self._terminal_score(board, side, ply)
+
+        # in check every evasion has to be looked at, otherwise standing still is an option
+        if not in_check:
+            stand_pat = evaluate(board, side)
+            if stand_pat >= beta or ply >= MAX_PLY - 1:
+                return stand_pat
+            alpha = max(alpha, stand_pat)
+            moves = [move for move in moves if move[2] is not None or self._is_capture(board, side, move)]
+
+        for move in self._order(board, side, moves, ply, None):
+            board.make(*move)
+            try:
+                score = -self._quiescence(board, 1 - side, -beta, -alpha, ply + 1)
+            finally:
+                board.unmake()
+
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+
+        return alpha
+
+    @staticmethod
+    def _is_capture(board, side, move):
+        if board.get_occupancy(1 - side) >> Board.position_to_index(move[1]) & 1:
+            return True
+        # en passant lands on an empty square
+        return move[1] == board.get_en_passant() and kind_on(board, side, Board.position_to_index(move[0])) == PAWN
+
+    def _remember_cutoff(self, move, depth, ply):
+        killers = self._killers[ply]
+        if killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+        self._history[move] = self._history.get(move, 0) + depth * depth
+
+    def _order(self, board, side, moves, ply, table_move):
+        """ (List<Tuple>) moves sorted so the most promising come first """
+        enemies = board.get_occupancy(1 - side)
+        killers = self._killers[ply]
+        history = self._history
+
+        def score(move):
+            if move == table_move:
+                return 1 << 30
+
+            to_index = Board.position_to_index(move[1])
+            if enemies >> to_index & 1:
+                # most valuable victim, least valuable attacker
+                victim = kind_on(board, 1 - side, to_index)
+                attacker = kind_on(board, side, Board.position_to_index(move[0]))
+                return (1 << 20) + PIECE_VALUES[victim] * 16 - PIECE_VALUES[attacker] // 16
+            if move[2] is not None:
+                return (1 << 20) + PIECE_VALUES[move[2]]
+            if move in killers:
+                return 1 << 19
+            return history.get(move, 0)
+
+        return sorted(moves, key=score, reverse=True)
+
+
+if __name__ == '__main__':
+    board = Board.from_fen(START_FEN)
+    engine = Engine()
+    move, score, depth = engine.search(board, board.get_turn(), budget=2)
+    print(f'best {move} score {score} depth {depth} nodes {engine.get_nodes()}')
@@ -0,0 +1,337 @@
+# Headless hosting of many chess games in one asyncio loop.
+# Games are looked up by id (a channel or a challenge), and games nobody has
+# touched for a while are packed into a few hundred bytes on disk and only
+# loaded back when someone plays in them again.
+import argparse
+import asyncio
+import os
+import random
+import struct
+import tracemalloc
+from time import monotonic, perf_counter
+
+from model import *
+from recorder import MOVE_FORMAT, decode_move, encode_move
+
+DEFAULT_FOLDER = 'games'
+IDLE_TIMEOUT = 600 # seconds without a move before a game is evicted
+EVICT_EVERY = 30
+
+# starting and remaining time of each player, the clock's increment and delay,
+# the length of each name and the number of moves, followed by the names, the
+# start position and the moves
+GAME_HEADER = struct.Struct('<ddddddHHH')
+
+
+def pack_game(game):
+    """ (bytes) A ChessGame packed for storage, its moves kept so repetitions and takebacks still work """
+    board = game.get_board()
+    moves = board.get_moves_played()
+    for _ in moves:
+        board.unmake()
+    start = board.to_bytes()
+    for move in moves:
+        board.make(*move)
+
+    white, black = game.get_player(WHITE), game.get_player(BLACK)
+    clock = game.get_clock()
+    names = [white.get_name().encode(), black.get_name().encode()]
+    header = GAME_HEADER.pack(white.get_starting_time(), game.get_time_left(WHITE), black.get_starting_time(),
+                              game.get_time_left(BLACK), clock.get_increment(), clock.get_delay(),
+                              len(names[0]), len(names[1]), len(moves))
+    return header + b''.join(names) + start + b''.join(MOVE_FORMAT.pack(encode_move(move)) for move in moves)
+
+
+def unpack_game(data):
+    """ (ChessGame) The game packed into data by pack_game, its clock running again """
+    (white_start, white_time, black_start, black_time, increment, delay,
+     white_length, black_length, count) = GAME_HEADER.unpack_from(data)
+    offset = GAME_HEADER.size
+    white = Player(data[offset:offset + white_length].decode(), white_start)
+    offset += white_length
+    black = Player(data[offset:offset + black_length].decode(), black_start)
+    offset += black_length
+    white.set_time(white_time)
+    black.set_time(black_time)
+
+    board = Board.from_bytes(data, offset)
+    offset += POSITION_SIZE
+    for _ in range(count):
+        board.make(*decode_move(MOVE_FORMAT.unpack_from(data, offset)[0]))
+        offset += MOVE_FORMAT.size
+    return make_game(white, black, board, increment, delay)
+
+
+def make_game(white, black, board, increment=0, delay=0):
+    """ (ChessGame) A game on board whose turn and running clock match the board's side to move """
+    game = ChessGame(white, black, board=board, clock=ChessClock(white, black, increment, delay))
+    if game.get_turn() != board.get_turn():
+        game.toggle_turn()
+        game.get_clock().start(game.get_turn())
+    return game
+
+
+class GameManager(object):
+    """ Keeps many ChessGames by id for one asyncio loop.
+
+    Games live in memory while in use. run_evictor writes games idle for
+    longer than idle_timeout to folder with pack_game and drops them, and
+    get_game loads them back on demand. Disk access runs in the loop's
+    default executor so a slow disk never stalls other games.
+
+    Each game in memory has one loop callback, scheduled for the moment the
+    side to move runs out of time. Clocks are paused while a game is on disk.
+    """
+
+    def __init__(self, folder=DEFAULT_FOLDER, idle_timeout=IDLE_TIMEOUT):
+        self._folder = folder
+        self._idle_timeout = idle_timeout
+        self._games = {} # id -> ChessGame
+        self._active = {} # id -> monotonic time of the last move
+        self._loading = {} # id -> future of a load in progress
+        self._evicting = {} # id -> future of the write of an evicted game, until it is on disk
+        self._flags = {} # id -> handle of the callback for the side to move running out of time
+        self._stats = dict.fromkeys(('moves', 'rejected', 'evictions', 'loads', 'flagged'), 0)
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, game_id):
+        # ids come from chat, so hex keeps them safe as file names
+        return os.path.join(self._folder, str(game_id).encode().hex() + '.game')
+
+    def new_game(self, game_id, white, black, fen=START_FEN, time=600, increment=0, delay=0):
+        """ (ChessGame) Starts a game under game_id, replacing any game it already had """
+        game = make_game(Player(white, time), Player(black, time), Board.from_fen(fen), increment, delay)
+        self._games[game_id] = game
+        self._active[game_id] = monotonic()
+        self._schedule_flag(game_id)
+        return game
+
+    def _schedule_flag(self, game_id):
+        handle = self._flags.pop(game_id, None)
+        if handle is not None:
+            handle.cancel()
+
+        game = self._games.get(game_id)
+        seconds = None if game is None else game.get_clock().get_time_to_flag()
+        if seconds is not None:
+            # without a running loop the next move schedules it instead
+            try:
+                self._flags[game_id] = asyncio.get_running_loop().call_later(seconds, self._flag, game_id)
+            except RuntimeError:
+                pass
+
+    def _flag(self, game_id):
+        self._flags.pop(game_id, None)
+        game = self._games.get(game_id)
+        if game is None:
+            return
+
+        side = game.get_turn()
+        if game.has_flagged(side):
+            game.get_clock().stop()
+            game.end('0-1' if side == WHITE else '1-0')
+            self._stats['flagged'] += 1
+        else:
+            self._schedule_flag(game_id)
+
+    def has_game(self, game_id):
+        return game_id in self._games or game_id in self._evicting or os.path.exists(self._path(game_id))
+
+    async def get_game(self, game_id):
+        """ (ChessGame) The game with game_id, loaded from disk if it was evicted, or None """
+        game = self._games.get(game_id)
+        if game is not None:
+            return game
+
+        # a game being evicted is loaded back once its file is complete
+        writing = self._evicting.get(game_id)
+        if writing is not None:
+            await asyncio.shield(writing)
+            game = self._games.get(game_id)
+            if game is not None:
+                return game
+
+        # several messages for an evicted game share one load
+        loading = self._loading.get(game_id)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load(game_id))
+            self._loading[game_id] = loading
+        try:
+            return await loading
+        finally:
+            self._loading.pop(game_id, None)
+
+    async def _load(self, game_id):
+        path = self._path(game_id)
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(None, _read_file, path)
+        except FileNotFoundError:
+            return None
+
+        game = self._games.get(game_id)
+        if game is None:
+            game = unpack_game(data)
+            self._games[game_id] = game
+            self._active[game_id] = monotonic()
+            self._schedule_flag(game_id)
+            self._stats['loads'] += 1
+        await loop.run_in_executor(None, os.remove, path)
+        return game
+
+    async def play(self, game_id, notation):
+        """ (Tuple) Plays a SAN or UCI move for the side to move in game_id, returning it (None if illegal) """
+        game = await self.get_game(game_id)
+        if game is None:
+            return None
+
+        # UCI can be matched against the cached moves, SAN needs every move's spelling worked out
+        side = game.get_turn()
+        notation = normalise_notation(notation)
+        move = next((move for move in game.get_legal_moves(side) if Board.move_to_uci(move) == notation), None)
+        if move is None:
+            move = game.get_board().parse_move(notation, side)
+        if move is None:
+            self._stats['rejected'] += 1
+            return None
+
+        if game.has_flagged(side):
+            self._stats['rejected'] += 1
+            return None
+
+        game.attempt_move(side, *move)
+        self._active[game_id] = monotonic()
+        self._schedule_flag(game_id)
+        self._stats['moves'] += 1
+        return move
+
+    async def take_back(self, game_id):
+        """ (bool) Takes back the last move in game_id, returning False if there was none """
+        game = await self.get_game(game_id)
+        if game is None or not game.undo_move():
+            return False
+
+        self._active[game_id] = monotonic()
+        self._schedule_flag(game_id)
+        return True
+
+    async def evict(self, game_id):
+        """ Writes a game to disk and forgets it """
+        game = self._games.pop(game_id, None)
+        self._active.pop(game_id, None)
+        if game is None:
+            return
+        self._schedule_flag(game_id)
+
+        data = pack_game(game)
+        writing = asyncio.get_running_loop().run_in_executor(None, _write_file, self._path(game_id), data)
+        self._evicting[game_id] = writing
+        try:
+            await writing
+        except OSError:
+            # keep playing from memory rather than lose the game
+            if game_id not in self._games:
+                self._games[game_id] = game
+                self._active[game_id] = monotonic()
+                self._schedule_flag(game_id)
+            raise
+        finally:
+            if self._evicting.get(game_id) is writing:
+                del self._evicting[game_id]
+        self._stats['evictions'] += 1
+
+    async def evict_idle(self):
+        """ (int) Evicts every game idle for longer than the idle timeout, returning how many """
+        cutoff = monotonic() - self._idle_timeout
+        idle = [game_id for game_id, active in self._active.items() if active < cutoff]
+        for game_id in idle:
+            await self.evict(game_id)
+        return len(idle)
+
+    async def run_evictor(self, every=EVICT_EVERY):
+        """ Evicts idle games forever, meant to be started as a task next to the bot """
+        while True:
+            await asyncio.sleep(every)
+            await self.evict_idle()
+
+    async def close(self):
+        """ Writes every game in memory to disk """
+        for game_id in list(self._games):
+            await self.evict(game_id)
+
+    def get_stats(self):
+        """ (Dict<str, int>) Games in memory, moves played and rejected, evictions, loads and games lost on time """
+        stats = dict(self._stats)
+        stats['games'] = len(self._games)
+        return stats
+
+
+def _read_file(path):
+    with open(path, 'rb') as game_file:
+        return game_file.read()
+
+
+def _write_file(path, data):
+    # write then rename, so a crash never leaves half a game behind
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as game_file:
+        game_file.write(data)
+    os.replace(temporary, path)
+
+
+async def synthetic_load(manager, games, moves, seed=0):
+    """ (float) Plays moves random moves in each of games games, interleaved, returning the seconds taken """
+    rng = random.Random(seed)
+    for number in range(games):
+        manager.new_game(f'game{number}', 'white', 'black')
+
+    start = perf_counter()
+    for _ in range(moves):
+        for number in range(games):
+            game = await manager.get_game(f'game{number}')
+            legal = game.get_legal_moves()
+            if legal:
+                await manager.play(f'game{number}', Board.move_to_uci(rng.choice(legal)))
+    return perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the game manager under synthetic load')
+    parser.add_argument('-g', '--games', type=int, default=200)
+    parser.add_argument('-m', '--moves', type=int, default=40, help='moves played in every game')
+    parser.add_argument('--folder', default=DEFAULT_FOLDER)
+    args = parser.parse_args()
+
+    async def run():
+        manager = GameManager(args.folder, idle_timeout=0)
+        elapsed = await synthetic_load(manager, args.games, args.moves)
+        stats = manager.get_stats()
+        print(f'{args.games} games, {stats["moves"]} moves in {elapsed:.2f}s ({stats["moves"] / elapsed:.0f} moves/s)')
+
+        start = perf_counter()
+        await manager.evict_idle()
+        evict_time = perf_counter() - start
+        on_disk = sum(os.path.getsize(os.path.join(args.folder, name)) for name in os.listdir(args.folder))
+
+        start = perf_counter()
+        for number in range(args.games):
+            await manager.get_game(f'game{number}')
+        load_time = perf_counter() - start
+
+        # tracing slows everything down, so memory is measured on its own by loading the games again
+        await manager.evict_idle()
+        tracemalloc.start()
+        for number in range(args.games):
+            await manager.get_game(f'game{number}')
+        in_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        print(f'{in_memory / args.games:.0f} bytes per game in memory, {on_disk / args.games:.0f} bytes per game '
+              f'on disk, evicted in {evict_time:.2f}s, loaded back in {load_time:.2f}s')
+        await manager.close()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
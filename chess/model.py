@@ -1,5 +1,8 @@
 # Models used in the chess game
 from pprint import pprint
+import random
+import struct
+from time import monotonic
 
 GRID_SIZE = 8
 WHITE = 0
@@ -7,14 +10,156 @@ BLACK = 1
 
 EMPTY_BOARD = (None,) * GRID_SIZE ** 2
 
+# Piece kinds, these index the bitboards kept by a Board
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+KINDS = 6
+
+FULL_MASK = (1 << GRID_SIZE ** 2) - 1
+
+# FEN letters for each kind, upper case for white
+FEN_LETTERS = 'pnbrqk'
+FILES = 'abcdefgh'
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+# the fixed size binary encoding of a position, see Board.to_bytes
+POSITION_FORMAT = struct.Struct('<Q16sBBBH3x')
+POSITION_SIZE = POSITION_FORMAT.size
+NO_SQUARE = 0xff
+
+ZOBRIST_SEED = 0x7477697463680000
+
+# positions whose legal moves a ChessGame remembers, a power of two. Only the
+# current position and the odd takeback need to be kept, and every game pays for it
+MOVE_CACHE_SIZE = 1 << 2
+
 
 class Board(object):
-    
-    def __init__(self, board=EMPTY_BOARD):
-        self._board = board
+    """ A chess position stored as bitboards.
+
+    Every (side, kind) pair gets its own integer mask where bit
+    `y * GRID_SIZE + x` is set when such a piece stands on (x, y), and each
+    side has an occupancy mask so emptiness and ownership are a single AND.
+
+    For compatibility a Board can still be built from a 64-tuple of pieces and
+    get_board() derives that tuple back out, so views iterating over squares
+    (ChessView.draw_board) keep working unchanged.
+    """
+
+    def __init__(self, board=EMPTY_BOARD, castling=None):
+        self._bitboards = [0] * (2 * KINDS)
+        self._occupancy = [0, 0]
+        self._squares = None
+        self._history = [] # undo records pushed by make
+        self._kings = [None, None] # index of each side's king
+        self._attacks = [None, None] # cached attack maps, see get_attacks
+        self._en_passant = None # index of the square a pawn just skipped over, if it can be taken
+        self._castling = 0 # bitmask of castling rights, see get_castling_rights
+        self._turn = WHITE
+        self._hash = 0 # zobrist key, updated as pieces are placed and removed
+        self._halfmove_clock = 0 # moves since the last capture or pawn move
+        self._fullmove = 1
+
+        for index, piece in enumerate(board):
+            if piece is None:
+                continue
+            self._place(index, piece.get_side(), piece.KIND)
+
+        # by default every king and rook still on its home square may castle
+        rights = self._home_rights()
+        self._set_castling(rights if castling is None else castling & rights)
+
+    def copy(self):
+        """ (Board) A new board with the same position """
+        result = Board.__new__(Board)
+        result._bitboards = self._bitboards[:]
+        result._occupancy = self._occupancy[:]
+        result._squares = None
+        result._history = []
+        result._kings = self._kings[:]
+        result._attacks = self._attacks[:]
+        result._en_passant = self._en_passant
+        result._castling = self._castling
+        result._turn = self._turn
+        result._hash = self._hash
+        result._halfmove_clock = self._halfmove_clock
+        result._fullmove = self._fullmove
+        return result
 
     def get_board(self):
-        return self._board
+        """ (Tuple<Piece>) The 64 squares of the board, derived from the bitboards """
+        if self._squares is None:
+            self._squares = tuple(self._make_piece(index) for index in range(GRID_SIZE ** 2))
+        return self._squares
+
+    def get_bitboard(self, side, kind):
+        """ (int) The mask of squares holding the given kind of piece for side """
+        return self._bitboards[side * KINDS + kind]
+
+    def get_occupancy(self, side=None):
+        """ (int) The mask of squares occupied by side, or by anyone if side is None """
+        if side is None:
+            return self._occupancy[WHITE] | self._occupancy[BLACK]
+        return self._occupancy[side]
+
+    def get_turn(self):
+        """ (int) The side to move, the opposite of whoever moved last """
+        return self._turn
+
+    def get_fullmove(self):
+        """ (int) The number of the current full move, starting at 1 and counting up after black moves """
+        return self._fullmove
+
+    def get_hash(self):
+        """ (int) The 64 bit zobrist key of this position.
+
+        The key covers pieces, side to move, castling rights and a capturable en
+        passant square, and is updated incrementally by make and unmake.
+        """
+        return self._hash
+
+    def get_castling_rights(self):
+        """ (int) Bitmask of castling rights: bit 2 * side + long is set while
+        that side's king and that rook are both home and unmoved """
+        return self._castling
+
+    def _home_rights(self):
+        """ (int) The castling rights whose king and rook are both on their home squares """
+        rights = 0
+        for side in (WHITE, BLACK):
+            offset = side * KINDS
+            king = KING_HOMES[side]
+            if not self._bitboards[offset + KING] >> king & 1:
+                continue
+            for long in (False, True):
+                rook = king - 4 if long else king + 3
+                if self._bitboards[offset + ROOK] >> rook & 1:
+                    rights |= 1 << (2 * side + long)
+        return rights
+
+    def _set_castling(self, rights):
+        if rights != self._castling:
+            self._hash ^= ZOBRIST_CASTLING[self._castling] ^ ZOBRIST_CASTLING[rights]
+            self._castling = rights
+
+    def count_repetitions(self):
+        """ (int) How many times the current position has occurred in this board's history, now included.
+
+        Only zobrist keys kept in the undo records are compared, and the search
+        stops at the last capture or pawn move since nothing before one can recur.
+        """
+        count = 1
+        for record in reversed(self._history):
+            if record[RECORD_HASH] == self._hash:
+                count += 1
+            if record[RECORD_KIND] == PAWN or record[RECORD_CAPTURED] is not None:
+                break
+        return count
+
+    def get_en_passant(self):
+        """ (Tuple<int, int>) The square a pawn can capture onto en passant, or None """
+        if self._en_passant is None:
+            return None
+        return Board.index_to_position(self._en_passant)
 
     @staticmethod
     def load(file):
@@ -36,31 +181,325 @@ class Board(object):
         x, y = position
         return y * GRID_SIZE + x # might have to think about this
 
+    @staticmethod
+    def index_to_position(index):
+        return index % GRID_SIZE, index // GRID_SIZE
+
     @staticmethod
     def notation_to_position(notation):
-        pass
+        """ (Tuple<int, int>) The position of a square in algebraic notation, e.g. 'e4' -> (4, 3) """
+        if len(notation) != 2 or notation[0] not in FILES or notation[1] not in '12345678':
+            raise ValueError(f'Invalid square: {notation!r}')
+        return FILES.index(notation[0]), int(notation[1]) - 1
+
+    @staticmethod
+    def position_to_notation(position):
+        """ (str) The algebraic name of a position, e.g. (4, 3) -> 'e4' """
+        x, y = position
+        return f'{FILES[x]}{y + 1}'
+
+    @staticmethod
+    def from_fen(fen):
+        """ (Board) The position described by a FEN string.
+
+        Missing trailing fields default to white to move, no castling, no en
+        passant and move 1. Raises ValueError if the placement is malformed.
+        """
+        fields = fen.split()
+        defaults = ['w', '-', '-', '0', '1']
+        placement = fields[0] if fields else ''
+        turn, castling, en_passant, halfmove, fullmove = fields[1:6] + defaults[len(fields[1:6]):]
+
+        board = Board()
+        ranks = placement.split('/')
+        if len(ranks) != GRID_SIZE:
+            raise ValueError(f'Invalid FEN placement: {placement!r}')
+
+        for row, rank in enumerate(ranks):
+            y = GRID_SIZE - 1 - row
+            x = 0
+            for letter in rank:
+                if letter.isdigit():
+                    x += int(letter)
+                    continue
+                if letter.lower() not in FEN_LETTERS or x >= GRID_SIZE:
+                    raise ValueError(f'Invalid FEN placement: {placement!r}')
+                side = WHITE if letter.isupper() else BLACK
+                board._place(y * GRID_SIZE + x, side, FEN_LETTERS.index(letter.lower()))
+                x += 1
+            if x != GRID_SIZE:
+                raise ValueError(f'Invalid FEN placement: {placement!r}')
+
+        rights = 0
+        for bit, letter in enumerate('KQkq'):
+            if letter in castling:
+                rights |= 1 << bit
+
+        square = None if en_passant == '-' else Board.position_to_index(Board.notation_to_position(en_passant))
+        board._set_state(WHITE if turn == 'w' else BLACK, rights, square, int(halfmove), int(fullmove))
+        return board
+
+    def to_fen(self):
+        """ (str) This position as a FEN string """
+        ranks = []
+        for y in reversed(range(GRID_SIZE)):
+            rank = ''
+            empty = 0
+            for x in range(GRID_SIZE):
+                found = self._piece_at(y * GRID_SIZE + x)
+                if found is None:
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                side, kind = found
+                rank += FEN_LETTERS[kind].upper() if side == WHITE else FEN_LETTERS[kind]
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+
+        castling = ''.join(letter for bit, letter in enumerate('KQkq') if self._castling >> bit & 1)
+        en_passant = '-'
+        if self._en_passant is not None:
+            en_passant = Board.position_to_notation(Board.index_to_position(self._en_passant))
+
+        turn = 'w' if self._turn == WHITE else 'b'
+        return f"{'/'.join(ranks)} {turn} {castling or '-'} {en_passant} {self._halfmove_clock} {self._fullmove}"
+
+    def to_bytes(self):
+        """ (bytes) This position packed into POSITION_SIZE (32) bytes.
+
+        The layout is the occupancy mask, then a 4 bit (side, kind) code for
+        each occupied square in order, then side to move with the castling
+        rights, the en passant square and the move counters.
+        """
+        occupied = self._occupancy[WHITE] | self._occupancy[BLACK]
+        codes = 0
+        shift = 0
+        pieces = occupied
+        while pieces:
+            bit = pieces & -pieces
+            pieces ^= bit
+            side, kind = self._piece_at(bit.bit_length() - 1)
+            codes |= (side * KINDS + kind) << shift
+            shift += 4
+
+        if shift > 128:
+            raise ValueError('Too many pieces to encode')
+
+        en_passant = NO_SQUARE if self._en_passant is None else self._en_passant
+        return POSITION_FORMAT.pack(occupied, codes.to_bytes(16, 'little'), self._turn | self._castling << 1,
+                                    en_passant, min(self._halfmove_clock, 0xff), self._fullmove & 0xffff)
+
+    @staticmethod
+    def from_bytes(data, offset=0):
+        """ (Board) The position packed by to_bytes, read from data at offset """
+        occupied, codes, flags, en_passant, halfmove, fullmove = POSITION_FORMAT.unpack_from(data, offset)
+        codes = int.from_bytes(codes, 'little')
+
+        board = Board()
+        while occupied:
+            bit = occupied & -occupied
+            occupied ^= bit
+            side, kind = divmod(codes & 0xf, KINDS)
+            board._place(bit.bit_length() - 1, side, kind)
+            codes >>= 4
+
+        square = None if en_passant == NO_SQUARE else en_passant
+        board._set_state(flags & 1, flags >> 1, square, halfmove, fullmove)
+        return board
+
+    def _set_state(self, turn, castling, en_passant, halfmove, fullmove):
+        """ Sets everything besides the pieces for a freshly placed board """
+        # a right only survives if its king and rook really are at home
+        self._set_castling(castling & self._home_rights())
+
+        if turn == BLACK:
+            self._hash ^= ZOBRIST_TURN
+        self._turn = turn
+
+        # as after make, only keep an en passant square that a pawn can take
+        if en_passant is not None and PAWN_ATTACK_MASKS[1 - turn][en_passant] & self._bitboards[turn * KINDS + PAWN]:
+            self._en_passant = en_passant
+            self._hash ^= ZOBRIST_EN_PASSANT[en_passant % GRID_SIZE]
+
+        self._halfmove_clock = halfmove
+        self._fullmove = fullmove
+
+    def _place(self, index, side, kind):
+        bit = 1 << index
+        self._bitboards[side * KINDS + kind] |= bit
+        self._occupancy[side] |= bit
+        self._hash ^= ZOBRIST_PIECES[side * KINDS + kind][index]
+        if kind == KING:
+            self._kings[side] = index
+
+    def _remove(self, index, side, kind):
+        mask = ~(1 << index)
+        self._bitboards[side * KINDS + kind] &= mask
+        self._occupancy[side] &= mask
+        self._hash ^= ZOBRIST_PIECES[side * KINDS + kind][index]
+        if kind == KING and self._kings[side] == index:
+            self._kings[side] = None
+
+    def _piece_at(self, index):
+        """ (Tuple<int, int>) The side and kind of the piece on index, or None if empty """
+        bit = 1 << index
+        if self._occupancy[WHITE] & bit:
+            side = WHITE
+        elif self._occupancy[BLACK] & bit:
+            side = BLACK
+        else:
+            return None
+
+        offset = side * KINDS
+        for kind in range(KINDS):
+            if self._bitboards[offset + kind] & bit:
+                return side, kind
+
+    def _make_piece(self, index):
+        found = self._piece_at(index)
+        if found is None:
+            return None
+
+        side, kind = found
+        return PIECES[side][kind]
+
+    def make(self, from_position, to_position, promotion=None):
+        """ Plays a move on this board in place, pushing an undo record for unmake.
+
+        A king moving two files is treated as castling and brings its rook
+        along, and a pawn moving diagonally onto the en passant square takes
+        the pawn behind it. Pawns reaching the last rank are promoted to
+        promotion, which defaults to a queen.
+        """
+        from_index = Board.position_to_index(from_position)
+        to_index = Board.position_to_index(to_position)
+        side, kind = self._piece_at(from_index)
+
+        captured_index = to_index
+        if kind == PAWN and to_index == self._en_passant:
+            captured_index = to_index - GRID_SIZE if side == WHITE else to_index + GRID_SIZE
+            captured = (1 - side, PAWN)
+        else:
+            captured = self._piece_at(to_index)
+
+        placed = kind
+        # promote pawns to queens on 8th rank
+        if kind == PAWN and to_index // GRID_SIZE == 7 - side * 7:
+            placed = QUEEN if promotion is None else promotion
+
+        rook_from = rook_to = None
+        if kind == KING and abs(to_index - from_index) == 2:
+            long = to_index < from_index
+            rook_from = from_index - 4 if long else from_index + 3
+            rook_to = from_index - 1 if long else from_index + 1
+
+        self._history.append((from_index, to_index, side, kind, placed, captured, captured_index, self._en_passant,
+                              rook_from, rook_to, self._attacks, self._castling, self._turn,
+                              self._hash, self._halfmove_clock))
+        self._attacks = [None, None]
+
+        if captured is not None:
+            self._remove(captured_index, *captured)
+        self._remove(from_index, side, kind)
+        self._place(to_index, side, placed)
+
+        if rook_from is not None:
+            self._remove(rook_from, side, ROOK)
+            self._place(rook_to, side, ROOK)
+
+        # a double pawn push leaves the square it skipped open to en passant, if an enemy pawn can take it
+        if self._en_passant is not None:
+            self._hash ^= ZOBRIST_EN_PASSANT[self._en_passant % GRID_SIZE]
+        self._en_passant = None
+        if kind == PAWN and abs(to_index - from_index) == 2 * GRID_SIZE:
+            skipped = (from_index + to_index) // 2
+            if PAWN_ATTACK_MASKS[side][skipped] & self._bitboards[(1 - side) * KINDS + PAWN]:
+                self._en_passant = skipped
+                self._hash ^= ZOBRIST_EN_PASSANT[skipped % GRID_SIZE]
+
+        # moving from or onto a king or rook home square loses the rights tied to it
+        if self._castling:
+            self._set_castling(self._castling & CASTLE_KEEP[from_index] & CASTLE_KEEP[to_index])
+
+        if side == self._turn:
+            self._hash ^= ZOBRIST_TURN
+        self._turn = 1 - side
+
+        if kind == PAWN or captured is not None:
+            self._halfmove_clock = 0
+        else:
+            self._halfmove_clock += 1
+        if side == BLACK:
+            self._fullmove += 1
+        self._squares = None
+
+    def unmake(self):
+        """ Takes back the last move played with make, restoring the board exactly """
+        (from_index, to_index, side, kind, placed, captured, captured_index, en_passant,
+         rook_from, rook_to, attacks, castling, turn, key, halfmove_clock) = self._history.pop()
+
+        self._remove(to_index, side, placed)
+        if captured is not None:
+            self._place(captured_index, *captured)
+        self._place(from_index, side, kind)
+
+        if rook_from is not None:
+            self._remove(rook_to, side, ROOK)
+            self._place(rook_from, side, ROOK)
+
+        self._en_passant = en_passant
+        self._attacks = attacks
+        self._castling = castling
+        self._turn = turn
+        self._hash = key
+        self._halfmove_clock = halfmove_clock
+        if side == BLACK:
+            self._fullmove -= 1
+        self._squares = None
+
+    def get_last_move(self):
+        """ (Tuple<Tuple<int, int>, Tuple<int, int>>) The last move played with make, or None """
+        if not self._history:
+            return None
+        from_index, to_index = self._history[-1][:2]
+        return Board.index_to_position(from_index), Board.index_to_position(to_index)
+
+    def get_move_count(self):
+        """ (int) The number of moves that can be taken back with unmake """
+        return len(self._history)
+
+    def get_moves_played(self):
+        """ (List<Tuple>) The moves that can be taken back with unmake, oldest first, as (from, to, promotion) """
+        return [(POSITIONS[from_index], POSITIONS[to_index], placed if placed != kind else None)
+                for from_index, to_index, _, kind, placed, *_ in self._history]
 
     def set_position(self, position, piece):
+        """ (Board) Return the board with position holding piece (or emptied if None) """
         index = Board.position_to_index(position)
-        return self._board[:index] + (piece,) + self._board[index + 1:]
+        result = self.copy()
+        result._attacks = [None, None]
+
+        found = result._piece_at(index)
+        if found is not None:
+            result._remove(index, *found)
+
+        if piece is not None:
+            result._place(index, piece.get_side(), piece.KIND)
+        result._set_castling(result._castling & CASTLE_KEEP[index])
+        return result
 
     def get_piece(self, position):
-        """ (Tuple<Piece, Player>) Gets information about the supplied position """
-        return self._board[Board.position_to_index(position)]
+        """ (Piece) Gets the piece on the supplied position, or None if it is empty """
+        return self._make_piece(Board.position_to_index(position))
 
     def move(self, from_position, to_position):
         """ (Board) Return the resultant board from moving the given position into the other """
-        piece = self.get_piece(from_position)
-
-        # promote pawns to queens on 8th rank
-        if self.is_promoting(from_position, to_position):
-            piece = Queen(piece.get_side())
-
-        intermediate = Board(board=self.set_position(to_position, piece))
-        result = intermediate.set_position(from_position, None)
-
-        piece.set_moved(True)
-        return Board(board=result)
+        result = self.copy()
+        result.make(from_position, to_position)
+        return result
 
     def castle(self, side, long):
         is_white = True if side == WHITE else False
@@ -68,15 +507,14 @@ class Board(object):
         y = rank.get(is_white, 0)
 
         king_position = (4, y)
-        rook_position = (rank[long], y)
 
         king_delta = (-2, 0) if long else (2, 0)
-        rook_delta = (1, 0) if long else (-1, 0)
         next_king_position = Board.add_position(king_position, king_delta)
-        next_rook_position = Board.add_position(next_king_position, rook_delta)
 
-        intermediate = self.move(king_position, next_king_position)
-        return intermediate.move(rook_position, next_rook_position)
+        # make moves the rook along with the king
+        result = self.copy()
+        result.make(king_position, next_king_position)
+        return result
 
     def is_castling(self, from_position, to_position):
         # Really stupid implementation
@@ -93,52 +531,24 @@ class Board(object):
         return False, None
 
     def can_castle(self, side, long):
-        is_white = True if side == WHITE else False
-        rank = {True: 0, False: 7}
-        y = rank.get(is_white, 0)
+        return self._can_castle(side, long, self.get_attacks(1 - side))
 
-        king_position = (4, y)
-        rook_position = (rank[long], y)
+    def _can_castle(self, side, long, danger):
+        """ (bool) Whether side may castle, given the mask of squares the enemy attacks """
+        king = 4 if side == WHITE else 4 + 7 * GRID_SIZE
+        rook = king - 4 if long else king + 3
 
-        king = self.get_piece(king_position)
-        if not isinstance(king, King) or king.has_moved():
+        # both pieces on their home squares and never moved
+        if not self._castling >> (2 * side + long) & 1:
             return False
 
-        rook = self.get_piece(rook_position)
-        if not isinstance(rook, Rook) or rook.has_moved():
-            return False
-
-        # check king in check
-        side = WHITE if is_white else BLACK
-        if self.is_in_check(side):
-            return False
-        
-        # get squares between them
-        if long:
-            xs = list(range(1, 4))
-        else:
-            xs = list(range(5, 7))
-        squares = [(x, y) for x in xs]
-
         # check nothing between them
-        for square in squares:
-            if self.get_piece(square) is not None:
-                return False
-
-        # check no move of king would be in check
-        for square in squares:
-            
-            # move king there
-            if square[0] == 1: # ignore this square
-                continue
-
-            intermediate = self.move(king_position, square)
-            king.set_moved(False)
-            # check if in check
-            if intermediate.is_in_check(side):
-                return False
+        if (self._occupancy[WHITE] | self._occupancy[BLACK]) & BETWEEN[king][rook]:
+            return False
 
-        return True
+        # the king can't be in check, pass through or land on an attacked square
+        path = (1 << king) | BETWEEN[king][king - 3 if long else king + 3]
+        return not danger & path
     
     def is_promoting(self, from_position, to_position):
         piece = self.get_piece(from_position)
@@ -153,42 +563,293 @@ class Board(object):
 
 
     def is_in_check(self, side):
-        king_position = None
-        for index, piece in enumerate(self._board):
-            if isinstance(piece, King) and piece.get_side() == side: 
-                king_position = index % GRID_SIZE, index // GRID_SIZE
-                king = piece
-
-        if king_position is None:
+        king = self._kings[side]
+        if king is None:
             return False
 
-        # check for danger squares
-        danger_squares = []
-        for delta in king.get_deltas(king_position):
-            # goes out in line of sight from the king in each direction
-            danger_squares.extend(king.follow_delta(king_position, delta, self))
+        return self._is_attacked(king, 1 - side)
+
+    def get_king_position(self, side):
+        """ (Tuple<int, int>) The square of side's king, or None if it has no king """
+        king = self._kings[side]
+        return None if king is None else Board.index_to_position(king)
+
+    def is_square_attacked(self, square, by_side):
+        """ (bool) Whether any piece of by_side attacks the given position """
+        return self._is_attacked(Board.position_to_index(square), by_side)
+
+    def _is_attacked(self, index, by_side):
+        return bool(self.get_attacks(by_side) >> index & 1)
+
+    def get_attacks(self, side):
+        """ (int) The mask of squares attacked by side.
+
+        The map is built once per position and cached. make stores the maps in
+        its undo record so unmake brings them straight back without any work.
+        """
+        attacks = self._attacks[side]
+        if attacks is None:
+            attacks = self._compute_attacks(side)
+            self._attacks[side] = attacks
+        return attacks
+
+    def _compute_attacks(self, side, occupied=None):
+        bitboards = self._bitboards
+        offset = side * KINDS
+        result = 0
+
+        for kind, masks in ((PAWN, PAWN_ATTACK_MASKS[side]), (KNIGHT, KNIGHT_MASKS), (KING, KING_MASKS)):
+            pieces = bitboards[offset + kind]
+            while pieces:
+                bit = pieces & -pieces
+                result |= masks[bit.bit_length() - 1]
+                pieces ^= bit
+
+        if occupied is None:
+            occupied = self._occupancy[WHITE] | self._occupancy[BLACK]
+        queens = bitboards[offset + QUEEN]
+        for pieces, deltas in ((bitboards[offset + ROOK] | queens, Rook._DELTAS),
+                               (bitboards[offset + BISHOP] | queens, Bishop._DELTAS)):
+            while pieces:
+                bit = pieces & -pieces
+                result |= slide_mask(bit.bit_length() - 1, deltas, occupied)
+                pieces ^= bit
 
-        # check king line of sight
-        for square in danger_squares:
-            piece = self.get_piece(square)
-            if piece is None or piece.get_side() == side:
+        return result
+
+    def _attackers(self, index, by_side, occupied):
+        """ (int) The mask of by_side's pieces attacking index, with sliders blocked by occupied """
+        bitboards = self._bitboards
+        enemy = by_side * KINDS
+        queens = bitboards[enemy + QUEEN]
+
+        # a pawn attacks index exactly when an enemy pawn on index would attack it back
+        return ((KNIGHT_MASKS[index] & bitboards[enemy + KNIGHT])
+                | (KING_MASKS[index] & bitboards[enemy + KING])
+                | (PAWN_ATTACK_MASKS[1 - by_side][index] & bitboards[enemy + PAWN])
+                | (slide_mask(index, Rook._DELTAS, occupied) & (bitboards[enemy + ROOK] | queens))
+                | (slide_mask(index, Bishop._DELTAS, occupied) & (bitboards[enemy + BISHOP] | queens)))
+
+    def _pins(self, king, side):
+        """ (Dict<int, int>) Maps each of side's pinned pieces to the line it may still move along """
+        pins = {}
+        enemy = (1 - side) * KINDS
+        bitboards = self._bitboards
+        queens = bitboards[enemy + QUEEN]
+        straight = bitboards[enemy + ROOK] | queens
+        diagonal = bitboards[enemy + BISHOP] | queens
+        own = self._occupancy[side]
+        occupied = own | self._occupancy[1 - side]
+
+        for delta in Queen._DELTAS:
+            sliders = straight if 0 in delta else diagonal
+            ray = RAY_MASKS[delta][king]
+            if not ray & sliders:
                 continue
-            
-            # if the piece is attacking our king
-            if king_position in piece.possible_moves(square, self):
-                return True
 
+            pinned = None
+            for square in RAYS[delta][king]:
+                if not occupied >> square & 1:
+                    continue
+                if pinned is None:
+                    # an enemy piece first is either a check or harmless
+                    if not own >> square & 1:
+                        break
+                    pinned = square
+                else:
+                    if sliders >> square & 1:
+                        pins[pinned] = ray ^ RAY_MASKS[delta][square]
+                    break
+
+        return pins
+
+    def legal_moves(self, side):
+        """ (List<Tuple<Tuple<int, int>, Tuple<int, int>, int>>) Every legal move for side.
+
+        Moves are (from_position, to_position, promotion) triples, where
+        promotion is the kind a pawn becomes or None, ready for make(*move).
+        They come from a single pass over the bitboards: pinned pieces are held
+        to the line through their king and, in check, every other piece must
+        capture or block the checker, so no move is ever tried on a board.
+        """
+        moves = []
+        append = moves.append
+        enemy = 1 - side
+        bitboards = self._bitboards
+        offset = side * KINDS
+        own = self._occupancy[side]
+        enemies = self._occupancy[enemy]
+        occupied = own | enemies
+        king = self._kings[side]
+
+        evasions = FULL_MASK
+        pins = {}
+        if king is not None:
+            # the king can't hide from a slider behind its own square
+            danger = self._compute_attacks(enemy, occupied & ~(1 << king))
+            origin = POSITIONS[king]
+            for target in JUMPS[KING][king]:
+                if not (own | danger) >> target & 1:
+                    append((origin, POSITIONS[target], None))
+
+            checkers = self._attackers(king, enemy, occupied)
+            if checkers & (checkers - 1):
+                # double check, only the king can move
+                return moves
+
+            if checkers:
+                evasions = checkers | BETWEEN[king][checkers.bit_length() - 1]
+            else:
+                for long in (False, True):
+                    if self._can_castle(side, long, danger):
+                        append((origin, POSITIONS[king - 2 if long else king + 2], None))
+
+            pins = self._pins(king, side)
+
+        allowed = ~own & evasions
+        for kind in (KNIGHT, BISHOP, ROOK, QUEEN):
+            pieces = bitboards[offset + kind]
+            while pieces:
+                bit = pieces & -pieces
+                pieces ^= bit
+                index = bit.bit_length() - 1
+
+                if kind == KNIGHT:
+                    targets = KNIGHT_MASKS[index]
+                else:
+                    targets = slide_mask(index, SLIDER_DELTAS[kind], occupied)
+                targets &= allowed & pins.get(index, FULL_MASK)
+
+                origin = POSITIONS[index]
+                while targets:
+                    target = targets & -targets
+                    targets ^= target
+                    append((origin, POSITIONS[target.bit_length() - 1], None))
+
+        last_rank = 7 - side * 7
+        pieces = bitboards[offset + PAWN]
+        while pieces:
+            bit = pieces & -pieces
+            pieces ^= bit
+            index = bit.bit_length() - 1
+
+            targets = PAWN_ATTACK_MASKS[side][index] & enemies
+            for target in PAWN_PUSHES[side][index]:
+                if occupied >> target & 1:
+                    break
+                targets |= 1 << target
+            targets &= evasions & pins.get(index, FULL_MASK)
+
+            origin = POSITIONS[index]
+            while targets:
+                target = targets & -targets
+                targets ^= target
+                target = target.bit_length() - 1
+                if target // GRID_SIZE == last_rank:
+                    for promotion in PROMOTIONS:
+                        append((origin, POSITIONS[target], promotion))
+                else:
+                    append((origin, POSITIONS[target], None))
+
+        ep = self._en_passant
+        if ep is not None:
+            captured = ep - GRID_SIZE if side == WHITE else ep + GRID_SIZE
+            if bitboards[enemy * KINDS + PAWN] >> captured & 1:
+                pieces = PAWN_ATTACK_MASKS[enemy][ep] & bitboards[offset + PAWN]
+                while pieces:
+                    bit = pieces & -pieces
+                    pieces ^= bit
+
+                    # both pawns leave their squares at once, so just look for attackers afterwards
+                    after = (occupied ^ bit ^ (1 << captured)) | (1 << ep)
+                    if king is None or not self._attackers(king, enemy, after) & ~(1 << captured):
+                        append((POSITIONS[bit.bit_length() - 1], POSITIONS[ep], None))
+
+        return moves
+
+    def move_to_san(self, move):
+        """ (str) The standard algebraic notation of a legal move, e.g. 'Nbd7', 'exd5', 'e8=Q+', 'O-O' """
+        side = self._piece_at(Board.position_to_index(move[0]))[0]
+        return self._san(move, self.legal_moves(side), check=True)
+
+    def _san(self, move, moves, check):
+        from_position, to_position, promotion = move
+        from_index = Board.position_to_index(from_position)
+        to_index = Board.position_to_index(to_position)
+        side, kind = self._piece_at(from_index)
+
+        if kind == KING and abs(to_index - from_index) == 2:
+            san = 'O-O-O' if to_index < from_index else 'O-O'
+        else:
+            capture = self._occupancy[1 - side] >> to_index & 1 or (kind == PAWN and to_index == self._en_passant)
+            target = Board.position_to_notation(to_position)
 
-        # imagine there is a knight on the king and see if any in possible moves are an enemy knight
-        knight = Knight(side)
-        for square in knight.possible_moves(king_position, self):
-            piece = self.get_piece(square)
-            if piece is None:
-                continue
-            if isinstance(piece, Knight) and piece.get_side() != side:
-                return True
+            if kind == PAWN:
+                san = f'{FILES[from_position[0]]}x{target}' if capture else target
+                if promotion is not None:
+                    san += '=' + FEN_LETTERS[promotion].upper()
+            else:
+                # name the file, rank or both when another piece of the same kind can get there too
+                others = [other[0] for other in moves if other[1] == to_position and other[0] != from_position
+                          and self._bitboards[side * KINDS + kind] >> Board.position_to_index(other[0]) & 1]
+                prefix = ''
+                if others:
+                    x, y = from_position
+                    if all(other[0] != x for other in others):
+                        prefix = FILES[x]
+                    elif all(other[1] != y for other in others):
+                        prefix = str(y + 1)
+                    else:
+                        prefix = Board.position_to_notation(from_position)
+                san = FEN_LETTERS[kind].upper() + prefix + ('x' if capture else '') + target
+
+        if check:
+            self.make(*move)
+            if self.is_in_check(1 - side):
+                san += '+' if self.legal_moves(1 - side) else '#'
+            self.unmake()
+        return san
+
+    @staticmethod
+    def move_to_uci(move):
+        """ (str) The long algebraic (UCI) notation of a move, e.g. 'e2e4' or 'e7e8q' """
+        from_position, to_position, promotion = move
+        result = Board.position_to_notation(from_position) + Board.position_to_notation(to_position)
+        if promotion is not None:
+            result += FEN_LETTERS[promotion]
+        return result
+
+    def move_notations(self, side):
+        """ (Dict<str, Tuple>) Maps every accepted spelling of side's legal moves to the move.
+
+        Spellings are the SAN (with or without 'x' and '='), the UCI form and
+        lower case versions of those, as long as the lower case spelling
+        doesn't also fit another move ('bxc3' could be a pawn or a bishop).
+        Build this once per position and look each typed move up in it.
+        """
+        moves = self.legal_moves(side)
+        result = {}
+        lowered = {}
+        for move in moves:
+            san = self._san(move, moves, check=False)
+            spellings = {san, san.replace('x', ''), san.replace('=', ''), Board.move_to_uci(move)}
+            if san.startswith('O-O'):
+                spellings.add(san.replace('O', '0'))
+
+            for spelling in spellings:
+                result[spelling] = move
+                # None marks a lower case spelling shared by different moves
+                lower = spelling.lower()
+                lowered[lower] = move if lowered.get(lower, move) == move else None
+
+        for spelling, move in lowered.items():
+            if move is not None:
+                result.setdefault(spelling, move)
+        return result
 
-        return False
+    def parse_move(self, notation, side):
+        """ (Tuple) The legal move for side written as SAN or UCI in notation, or None if it isn't one """
+        return self.move_notations(side).get(normalise_notation(notation))
 
     @staticmethod
     def is_valid_position(position):
@@ -208,67 +869,82 @@ class Board(object):
         return x - dx, y - dy
 
     def display(self):
+        squares = self.get_board()
         result = []
         for row in range(GRID_SIZE):
             start = row * GRID_SIZE
             end = (row + 1) * GRID_SIZE
-            result.append([str(x) for x in self._board[start:end]])
+            result.append([str(x) for x in squares[start:end]])
         result.reverse()
         pprint(result)
 
 
 class Piece(object):
+    """ A kind of piece for one side.
+
+    Pieces are immutable flyweights: Pawn(WHITE) always returns the same shared
+    instance, so boards can hand them out freely. Whether a king or rook has
+    moved is part of the board's castling rights, not the piece.
+    """
+    __slots__ = ('_side',)
+    _DELTAS = ()
+    _JUMPS = False
+    _instances = {}
+
+    def __new__(cls, side):
+        piece = Piece._instances.get((cls, side))
+        if piece is None:
+            piece = super().__new__(cls)
+            object.__setattr__(piece, '_side', side)
+            Piece._instances[cls, side] = piece
+        return piece
 
-    def __init__(self, move_deltas, side, jumps=False):
-        self._deltas = move_deltas
-        self._side = side
-        self._jumps = jumps
-        self._has_moved = False
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} pieces are immutable')
 
-    def get_deltas(self, position):
-        return self._deltas
+    def __reduce__(self):
+        return type(self), (self._side,)
 
-    def has_moved(self):
-        return self._has_moved
-
-    def set_moved(self, moved):
-        self._has_moved = moved
+    def get_deltas(self, position):
+        return self._DELTAS
 
     def get_side(self):
         return self._side
     
     def possible_moves(self, position, board):
         result = []
-        deltas = self.get_deltas(position)
-        #TODO REMOVE print('deltas:', deltas)
-        for delta in deltas:
-            if self._jumps:
-                next_position = Board.add_position(position, delta)
-                if not Board.is_valid_position(next_position):
-                    continue
-                piece = board.get_piece(next_position)
-                if piece is None or piece.get_side() != self._side:
-                    result.append(next_position)
+        index = Board.position_to_index(position)
+        own = board.get_occupancy(self._side)
 
-            else:
-                result.extend(self.follow_delta(position, delta, board))
+        if self._JUMPS:
+            for target in JUMPS[self.KIND][index]:
+                if not own >> target & 1:
+                    result.append(POSITIONS[target])
+            return result
+
+        occupied = board.get_occupancy()
+        for delta in self.get_deltas(position):
+            for target in RAYS[delta][index]:
+                if occupied >> target & 1:
+                    # add the piece that could be taken if it's on the enemy side
+                    if not own >> target & 1:
+                        result.append(POSITIONS[target])
+                    break
+                result.append(POSITIONS[target])
         return result
     
     def follow_delta(self, position, delta, board):
+        """ (List<Tuple<int, int>>) The squares reached from position along delta, up to the first piece """
         result = []
-        next_position = Board.add_position(position, delta)
+        own = board.get_occupancy(self._side)
+        occupied = board.get_occupancy()
 
-        if not Board.is_valid_position(next_position):
-            return result
-
-        piece = board.get_piece(next_position)
-        # keep extending tell we reach a piece
-        if piece is None:
-            result.append(next_position)
-            result.extend(self.follow_delta(next_position, delta, board))
-        # add the piece that could be taken if it's on the enemy side
-        elif piece.get_side() != self._side:
-            result.append(next_position)
+        for target in RAYS[delta][Board.position_to_index(position)]:
+            if occupied >> target & 1:
+                if not own >> target & 1:
+                    result.append(POSITIONS[target])
+                break
+            result.append(POSITIONS[target])
 
         return result
 
@@ -310,23 +986,122 @@ class Player(object):
     def get_time(self):
         return self._time
 
+    def get_starting_time(self):
+        return self._starting_time
+
     def change_time(self, delta):
         self._time += delta
         self._time = max(0, min(self._time, self._starting_time))
 
+    def set_time(self, time):
+        # unlike change_time this can go past the starting time, as increments do
+        self._time = max(0, time)
+
     def has_lost_on_time(self):
         return self._time == 0
 
 
+class ChessClock(object):
+    """ The two clocks of a game, counted with time.monotonic deadlines.
+
+    Nothing ticks: only the side to move has a running clock and its time
+    left is worked out from when its turn started whenever it is asked
+    for. press charges the time used, less the delay, adds the increment
+    and starts the other side. get_time_to_flag says when to schedule the
+    single wakeup at which the side to move runs out. Each player's time
+    is written back on every press.
+    """
+
+    def __init__(self, white, black, increment=0, delay=0, timer=monotonic):
+        self._players = (white, black)
+        self._remaining = [white.get_time(), black.get_time()] # as of the start of the running turn
+        self._increment = increment
+        self._delay = delay # seconds of each turn that aren't charged
+        self._timer = timer
+        self._running = None
+        self._started = None
+
+    def start(self, side):
+        """ Starts side's clock, stopping the other one """
+        self.stop()
+        self._running = side
+        self._started = self._timer()
+
+    def stop(self):
+        """ Stops whichever clock is running, charging the time it used """
+        if self._running is not None:
+            side = self._running
+            self._remaining[side] = self.get_remaining(side)
+            self._players[side].set_time(self._remaining[side])
+            self._running = None
+
+    def get_running(self):
+        """ (int) The side whose time is running, or None """
+        return self._running
+
+    def get_increment(self):
+        return self._increment
+
+    def get_delay(self):
+        return self._delay
+
+    def get_remaining(self, side):
+        """ (float) Seconds side has left right now """
+        if side != self._running:
+            return self._remaining[side]
+        used = max(0, self._timer() - self._started - self._delay)
+        return max(0, self._remaining[side] - used)
+
+    def get_time_to_flag(self):
+        """ (float) Seconds until the running side runs out, or None if no clock is running """
+        if self._running is None:
+            return None
+        return max(0, self._started + self._delay + self._remaining[self._running] - self._timer())
+
+    def has_flagged(self, side):
+        """ (bool) Whether side has run out of time """
+        return self.get_remaining(side) <= 0
+
+    def press(self, side):
+        """ (bool) Ends side's turn and starts the other side, False (and stopped) if side had run out """
+        if self.has_flagged(side):
+            self.stop()
+            return False
+
+        remaining = self.get_remaining(side) + self._increment
+        self._running = None
+        self._remaining[side] = remaining
+        self._players[side].set_time(remaining)
+        self.start(1 - side)
+        return True
+
+    def take_back(self, side):
+        """ Gives side its turn back after its last move is taken back, charging the time the other side used """
+        self.stop()
+        # the increment comes again when the move is played again
+        self._remaining[side] = max(0, self._remaining[side] - self._increment)
+        self._players[side].set_time(self._remaining[side])
+        self.start(side)
+
+
 class ChessGame(object):
     
-    def __init__(self, white, black, board=None):
+    def __init__(self, white, black, board=None, recorder=None, book=None, clock=None):
         self._white = white
         self._black = black
         self._turn = WHITE
         self._board = board
         if board is None:
             self._board = Board(board=EMPTY_BOARD)
+        self._recorder = recorder # a GameRecorder (see recorder.py) every move is streamed to
+        self._book = book # an OpeningBook (see book.py) for playing known openings without thinking
+        self._clock = clock
+        if clock is not None:
+            clock.start(self._turn)
+        if recorder is not None:
+            recorder.start_game(self._board, white.get_name(), black.get_name())
+        # legal moves by position key, so clicks, highlights and attempt_move share one generation
+        self._moves = TranspositionTable(MOVE_CACHE_SIZE)
 
     def get_turn(self):
         return self._turn
@@ -334,57 +1109,232 @@ class ChessGame(object):
     def get_board(self):
         return self._board
 
+    def get_player(self, side):
+        return self._white if side == WHITE else self._black
+
+    def get_clock(self):
+        return self._clock
+
+    def get_time_left(self, side):
+        """ (float) Seconds side has left, from the clock while one is running """
+        if self._clock is not None:
+            return self._clock.get_remaining(side)
+        return self.get_player(side).get_time()
+
+    def has_flagged(self, side):
+        """ (bool) Whether side has lost on time """
+        if self._clock is not None:
+            return self._clock.has_flagged(side)
+        return self.get_player(side).has_lost_on_time()
+
     def toggle_turn(self):
         self._turn = (self._turn + 1) % len([WHITE, BLACK])
 
-    def can_move(self, side, from_position, to_position):
+    def get_legal_moves(self, side=None):
+        """ (List<Tuple>) The legal moves of side (default the side to move) in the current position.
+
+        Moves are generated once per position: the cache is keyed by the
+        board's zobrist key, so any move or takeback moves on to a new entry.
+        """
+        if side is None:
+            side = self._turn
+        return cached_legal_moves(self._board, side, self._moves)
+
+    def get_book_move(self, side=None):
+        """ (Tuple) A move from the opening book for side (default the side to move), or None """
+        if self._book is None:
+            return None
+        return self._book.choose(self._board, self._turn if side is None else side)
+
+    def get_targets(self, from_position):
+        """ (List<Tuple<int, int>>) The squares the piece on from_position can legally move to """
+        piece = self._board.get_piece(from_position)
+        if piece is None:
+            return []
+
+        # promotions are only listed once
+        targets = []
+        for move in self.get_legal_moves(piece.get_side()):
+            if move[0] == from_position and move[1] not in targets:
+                targets.append(move[1])
+        return targets
+
+    def find_move(self, side, from_position, to_position, promotion=None):
+        """ (Tuple) The legal (from, to, promotion) move matching the arguments, or None.
+
+        promotion has to be one the pawn can become, or None for a queen.
+        Moves that don't promote only match a promotion of None.
+        """
         # check if proper turn
         if side != self._turn:
-            return False
+            return None
 
         piece = self._board.get_piece(from_position)
         if piece is None:
-            return False
+            return None
 
         # check if own piece at that position
         if piece.get_side() != side:
-            return False
-        
-        # check if valid move
-        #print('sex', piece.possible_moves(from_position, self._board))
-        if to_position not in piece.possible_moves(from_position, self._board):
-            return False
+            return None
 
-        next_state = self._board.move(from_position, to_position)
-        # check if in check
-        if next_state.is_in_check(side):
-            return False
+        # check if valid move, legal_moves already leaves out moves into check
+        for move in self.get_legal_moves(side):
+            if move[0] == from_position and move[1] == to_position:
+                if move[2] == promotion or (promotion is None and move[2] == QUEEN):
+                    return move
 
-        return True
+        return None
+
+    def can_move(self, side, from_position, to_position, promotion=None):
+        return self.find_move(side, from_position, to_position, promotion) is not None
 
-    def attempt_move(self, side, from_position, to_position):
-        if not self.can_move(side, from_position, to_position):
+    def attempt_move(self, side, from_position, to_position, promotion=None):
+        # the legal move spells out the queen a promotion of None stands for, so recordings replay
+        move = self.find_move(side, from_position, to_position, promotion)
+        if move is None:
             print("Invalid move")
             return 
-        
-        # TODO change to keep track of all past states
 
-        castling, *args = self._board.is_castling(from_position, to_position)
-        if castling:
-            self._board = self._board.castle(*args)
-        else:
-            self._board = self._board.move(from_position, to_position)
+        # the move only counts if it was made in time
+        if self._clock is not None and not self._clock.press(side):
+            print("Out of time")
+            self.end('0-1' if side == WHITE else '1-0')
+            return
+
+        # the board keeps an undo record for every move made, castling included
+        self._board.make(*move)
         self.toggle_turn()
+        if self._recorder is not None:
+            self._recorder.record(move)
+
+    def is_threefold_repetition(self):
+        """ (bool) Whether the current position has now occurred three times """
+        return self._board.count_repetitions() >= 3
+
+    def undo_move(self):
+        """ (bool) Takes back the last move played, returns False if there was none """
+        if self._board.get_move_count() == 0:
+            return False
+
+        self._board.unmake()
+        self.toggle_turn()
+        if self._clock is not None:
+            self._clock.take_back(self._turn)
+        if self._recorder is not None:
+            self._recorder.take_back()
+        return True
+
+    def end(self, result='*'):
+        """ Finishes the game with a PGN result such as '1-0', flushing its recording to disk """
+        if self._recorder is not None:
+            self._recorder.finish(result)
+
+
+
+def pack_positions(boards):
+    """ (bytes) The to_bytes encodings of boards back to back """
+    return b''.join(board.to_bytes() for board in boards)
+
+
+def unpack_positions(data):
+    """ Yields each Board packed back to back in data by pack_positions """
+    for offset in range(0, len(data) - POSITION_SIZE + 1, POSITION_SIZE):
+        yield Board.from_bytes(data, offset)
+
+
+def normalise_notation(notation):
+    """ (str) Typed move notation with surrounding space and check or comment marks removed """
+    return notation.strip().rstrip('+#!?')
+
+
+class TranspositionTable(object):
+    """ A fixed size cache of values keyed by zobrist key (Board.get_hash).
+
+    Each key maps to one slot. A store only replaces a slot holding another
+    position when it was searched at least as deep, so expensive results
+    survive cheap ones. Values can be anything: legal move lists, check
+    status or search results, ideally with one table per kind of value.
+    """
+
+    def __init__(self, size=1 << 16):
+        # round up to a power of two so a key can be masked into a slot
+        size = 1 << max(0, size - 1).bit_length()
+        self._mask = size - 1
+        self._keys = [None] * size
+        self._depths = [0] * size
+        self._values = [None] * size
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key, depth=0):
+        """ Gets the value stored for key from a search of at least depth, or None """
+        slot = key & self._mask
+        if self._keys[slot] == key and self._depths[slot] >= depth:
+            self._hits += 1
+            return self._values[slot]
+
+        self._misses += 1
+        return None
+
+    def store(self, key, value, depth=0):
+        """ Stores value for key unless its slot holds a deeper result for another key """
+        slot = key & self._mask
+        if self._keys[slot] not in (None, key) and self._depths[slot] > depth:
+            return
+
+        self._keys[slot] = key
+        self._depths[slot] = depth
+        self._values[slot] = value
+
+    def clear(self):
+        size = self._mask + 1
+        self._keys = [None] * size
+        self._depths = [0] * size
+        self._values = [None] * size
+        self._hits = self._misses = 0
+
+    def get_stats(self):
+        """ (Dict<str, int>) Slots in use, size, hits and misses """
+        return {
+            'used': sum(key is not None for key in self._keys),
+            'size': self._mask + 1,
+            'hits': self._hits,
+            'misses': self._misses,
+        }
+
+
+def cached_legal_moves(board, side, table):
+    """ (List<Tuple>) board.legal_moves(side), cached in table by position """
+    key = board.get_hash()
+    if side != board.get_turn():
+        key ^= ZOBRIST_TURN
+
+    moves = table.get(key)
+    if moves is None:
+        moves = board.legal_moves(side)
+        table.store(key, moves)
+    return moves
+
+
+def cached_is_in_check(board, side, table):
+    """ (bool) board.is_in_check(side), cached in table by position """
+    key = board.get_hash() ^ ZOBRIST_CHECK[side]
+
+    in_check = table.get(key)
+    if in_check is None:
+        in_check = board.is_in_check(side)
+        table.store(key, in_check)
+    return in_check
 
 
 
 ################## PIECES ###################
 
 class King(Piece):
+    __slots__ = ()
+    KIND = KING
     _DELTAS = [(1, 1), (1, 0), (1, -1), (0, 1), (0, -1), (-1, 1), (-1, 0), (-1, -1)]
-    
-    def __init__(self, side):
-        super().__init__(move_deltas=self._DELTAS, side=side, jumps=True)
+    _JUMPS = True
 
     def possible_moves(self, position, board):
         result = super().possible_moves(position, board)
@@ -402,20 +1352,19 @@ class King(Piece):
     
 
 class Knight(Piece):
+    __slots__ = ()
+    KIND = KNIGHT
     _DELTAS = [(1, 2), (-1, 2), (1, -2), (-1, -2), (2, 1), (-2, 1), (2, -1), (-2, -1)]
-    
-    def __init__(self, side):
-        super().__init__(move_deltas=self._DELTAS, side=side, jumps=True)
+    _JUMPS = True
 
     def __str__(self):
         return f'N:{self._side}'
 
 class Queen(Piece):
 
+    __slots__ = ()
+    KIND = QUEEN
     _DELTAS = [(1, 1), (1, 0), (1, -1), (0, 1), (0, -1), (-1, 1), (-1, 0), (-1, -1)]
-    
-    def __init__(self, side):
-        super().__init__(move_deltas=self._DELTAS, side=side, jumps=False)
 
     def __str__(self):
         return f'Q:{self._side}'
@@ -423,33 +1372,31 @@ class Queen(Piece):
 
 class Rook(Piece):
 
+    __slots__ = ()
+    KIND = ROOK
     _DELTAS = [(1, 0), (0, 1), (0, -1), (-1, 0)]
-    
-    def __init__(self, side):
-        super().__init__(move_deltas=self._DELTAS, side=side, jumps=False)
 
     def __str__(self):
         return f'R:{self._side}'
 
 class Bishop(Piece):
 
+    __slots__ = ()
+    KIND = BISHOP
     _DELTAS = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
-    
-    def __init__(self, side):
-        super().__init__(move_deltas=self._DELTAS, side=side, jumps=False)
 
     def __str__(self):
         return f'B:{self._side}'
 
 
 class Pawn(Piece):
+    __slots__ = ()
+    KIND = PAWN
     _DELTAS = [(0, 1)]
-
-    def __init__(self, side):
-        super().__init__(move_deltas=self._DELTAS, side=side, jumps=True)
+    _JUMPS = True
 
     def get_deltas(self, position):
-        result = self._deltas[:]
+        result = self._DELTAS[:]
         # add extra move at start
         if self._side == WHITE and position[1] == 1:
             result.append((0, 2))
@@ -465,41 +1412,135 @@ class Pawn(Piece):
 
     def possible_moves(self, position, board):
         result = []
-        deltas = self.get_deltas(position)
-        #TODO REMOVE print('deltas:', deltas)
-        for delta in deltas:
-            next_position = Board.add_position(position, delta)
-            if not Board.is_valid_position(next_position):
-                continue
+        index = Board.position_to_index(position)
+        occupied = board.get_occupancy()
 
-            piece = board.get_piece(next_position)
+        # the double jump stops at the first piece in the way
+        for target in PAWN_PUSHES[self._side][index]:
+            if occupied >> target & 1:
+                break
+            result.append(POSITIONS[target])
 
-            # if diagonal make sure enemy piece there
-            if next_position[0] != position[0]:
-                if piece is None:
-                    continue
-                if piece.get_side() != self._side:
-                    result.append(next_position)
+        # diagonals need an enemy piece there, or the square it just skipped
+        enemies = board.get_occupancy(1 - self._side)
+        en_passant = board.get_en_passant()
+        for target in PAWN_CAPTURES[self._side][index]:
+            if enemies >> target & 1 or POSITIONS[target] == en_passant:
+                result.append(POSITIONS[target])
 
-            if piece is not None:
-                continue
-            
-            # if double jump make sure no piece in the way
-            if abs(delta[1]) == 2:
-                partial_delta = delta[0], round(delta[1] / 2)
-                middle_position = Board.add_position(position, partial_delta)
-                if board.get_piece(middle_position) is not None:
-                    continue
-
-            
-            result.append(next_position)
-           
         return result
 
     def __str__(self):
         return f'p:{self._side}'
 
 
+################## TABLES ###################
+
+def ray_squares(index, delta):
+    """ (Tuple<int>) The squares from index outwards along delta, nearest first """
+    result = []
+    position = Board.add_position(Board.index_to_position(index), delta)
+    while Board.is_valid_position(position):
+        result.append(Board.position_to_index(position))
+        position = Board.add_position(position, delta)
+    return tuple(result)
+
+
+def leaper_squares(deltas):
+    """ (Tuple<Tuple<int>>) For each square, the squares one delta away from it """
+    result = []
+    for index in range(GRID_SIZE ** 2):
+        position = Board.index_to_position(index)
+        squares = []
+        for delta in deltas:
+            next_position = Board.add_position(position, delta)
+            if Board.is_valid_position(next_position):
+                squares.append(Board.position_to_index(next_position))
+        result.append(tuple(squares))
+    return tuple(result)
+
+
+def to_masks(table):
+    """ (Tuple<int>) Converts a per square table of squares into per square masks """
+    return tuple(sum(1 << square for square in squares) for squares in table)
+
+
+def between_masks():
+    """ (Tuple<Tuple<int>>) For each pair of squares on a line, the mask of squares strictly between them """
+    result = [[0] * GRID_SIZE ** 2 for _ in range(GRID_SIZE ** 2)]
+    for index in range(GRID_SIZE ** 2):
+        for delta, rays in RAYS.items():
+            for square in rays[index]:
+                result[index][square] = RAY_MASKS[delta][index] ^ RAY_MASKS[delta][square] ^ (1 << square)
+    return tuple(tuple(row) for row in result)
+
+
+def slide_mask(index, deltas, occupied):
+    """ (int) The squares a slider on index reaches along deltas, stopping at (and including) blockers """
+    result = 0
+    for delta in deltas:
+        ray = RAY_MASKS[delta][index]
+        blockers = ray & occupied
+        if blockers:
+            # the nearest blocker is the lowest bit on rays going up the board, the highest otherwise
+            if delta in ASCENDING_DELTAS:
+                blocker = (blockers & -blockers).bit_length() - 1
+            else:
+                blocker = blockers.bit_length() - 1
+            ray ^= RAY_MASKS[delta][blocker]
+        result |= ray
+    return result
+
+
+PIECE_CLASSES = (Pawn, Knight, Bishop, Rook, Queen, King)
+PIECES = tuple(tuple(cls(side) for cls in PIECE_CLASSES) for side in (WHITE, BLACK)) # the 12 shared pieces
+PROMOTIONS = (QUEEN, ROOK, BISHOP, KNIGHT)
+SLIDER_DELTAS = {BISHOP: Bishop._DELTAS, ROOK: Rook._DELTAS, QUEEN: Queen._DELTAS}
+
+POSITIONS = tuple(Board.index_to_position(index) for index in range(GRID_SIZE ** 2))
+
+RAYS = {delta: tuple(ray_squares(index, delta) for index in range(GRID_SIZE ** 2)) for delta in Queen._DELTAS}
+RAY_MASKS = {delta: to_masks(rays) for delta, rays in RAYS.items()}
+ASCENDING_DELTAS = frozenset((dx, dy) for (dx, dy) in Queen._DELTAS if dy > 0 or (dy == 0 and dx > 0))
+
+JUMPS = {
+    KNIGHT: leaper_squares(Knight._DELTAS),
+    KING: leaper_squares(King._DELTAS),
+}
+KNIGHT_MASKS = to_masks(JUMPS[KNIGHT])
+KING_MASKS = to_masks(JUMPS[KING])
+
+PAWN_PUSHES = (
+    tuple(RAYS[(0, 1)][index][:2 if index // GRID_SIZE == 1 else 1] for index in range(GRID_SIZE ** 2)),
+    tuple(RAYS[(0, -1)][index][:2 if index // GRID_SIZE == 6 else 1] for index in range(GRID_SIZE ** 2)),
+)
+PAWN_CAPTURES = (leaper_squares([(1, 1), (-1, 1)]), leaper_squares([(1, -1), (-1, -1)]))
+PAWN_ATTACK_MASKS = (to_masks(PAWN_CAPTURES[WHITE]), to_masks(PAWN_CAPTURES[BLACK]))
+
+BETWEEN = between_masks()
+
+KING_HOMES = (Board.position_to_index((4, 0)), Board.position_to_index((4, GRID_SIZE - 1)))
+
+# castling rights kept when a move starts or ends on each square, so make only needs two ANDs
+CASTLE_KEEP = [0b1111] * GRID_SIZE ** 2
+for _side in (WHITE, BLACK):
+    CASTLE_KEEP[KING_HOMES[_side]] &= ~(0b11 << 2 * _side)
+    CASTLE_KEEP[KING_HOMES[_side] + 3] &= ~(1 << 2 * _side)
+    CASTLE_KEEP[KING_HOMES[_side] - 4] &= ~(2 << 2 * _side)
+CASTLE_KEEP = tuple(CASTLE_KEEP)
+
+# fields of the undo records kept by Board.make
+RECORD_KIND, RECORD_CAPTURED, RECORD_HASH = 3, 5, 13
+
+# random keys xored together into Board.get_hash, seeded so keys are the same every run
+_keys = random.Random(ZOBRIST_SEED)
+ZOBRIST_PIECES = tuple(tuple(_keys.getrandbits(64) for _ in range(GRID_SIZE ** 2)) for _ in range(2 * KINDS))
+ZOBRIST_CASTLING = (0,) + tuple(_keys.getrandbits(64) for _ in range(15))
+ZOBRIST_EN_PASSANT = tuple(_keys.getrandbits(64) for _ in range(GRID_SIZE))
+ZOBRIST_TURN = _keys.getrandbits(64)
+ZOBRIST_CHECK = (_keys.getrandbits(64), _keys.getrandbits(64)) # keeps cached check status apart from other values
+
+
 if __name__ == "__main__":
     board = Board.load('default_board.txt')
     board.display()
@@ -0,0 +1,160 @@
+# Perft (performance test) for the chess model.
+# Counts the leaf nodes of the legal move tree and compares them to known
+# results, timing move generation, make/unmake and check tests as it goes.
+import argparse
+import sys
+from time import perf_counter
+
+from model import *
+
+# name, FEN, known node counts for depth 1, 2, 3, ...
+POSITIONS = [
+    ('start', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+     (20, 400, 8902, 197281, 4865609)),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+     (48, 2039, 97862, 4085603)),
+    ('position3', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+     (14, 191, 2812, 43238, 674624)),
+    ('position4', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+     (6, 264, 9467, 422333)),
+    ('position5', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+     (44, 1486, 62379, 2103487)),
+    ('position6', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+     (46, 2079, 89890, 3894594)),
+]
+
+DEFAULT_DEPTH = 3
+PHASES = ('generate', 'make', 'check')
+
+
+def load_position(fen):
+    """ (Tuple<Board, int>) The board described by a FEN string and its side to move """
+    board = Board.from_fen(fen)
+    return board, board.get_turn()
+
+
+def perft(board, side, depth):
+    """ (int) The number of leaf nodes depth plies below board, with side to move """
+    if depth == 0:
+        return 1
+
+    moves = board.legal_moves(side)
+    if depth == 1:
+        return len(moves)
+
+    nodes = 0
+    for move in moves:
+        board.make(*move)
+        nodes += perft(board, 1 - side, depth - 1)
+        board.unmake()
+    return nodes
+
+
+def divide(board, side, depth):
+    """ (Dict<Tuple, int>) The perft count below each root move, for tracking down mistakes """
+    result = {}
+    for move in board.legal_moves(side):
+        board.make(*move)
+        result[move] = perft(board, 1 - side, depth - 1)
+        board.unmake()
+    return result
+
+
+def profile(board, side, depth, timings):
+    """ (int) Same as perft, but adds the seconds spent in each phase into timings """
+    if depth == 0:
+        return 1
+
+    start = perf_counter()
+    moves = board.legal_moves(side)
+    timings['generate'] += perf_counter() - start
+    if depth == 1:
+        return len(moves)
+
+    nodes = 0
+    for move in moves:
+        start = perf_counter()
+        board.make(*move)
+        timings['make'] += perf_counter() - start
+
+        start = perf_counter()
+        board.is_in_check(1 - side)
+        timings['check'] += perf_counter() - start
+
+        nodes += profile(board, 1 - side, depth - 1, timings)
+
+        start = perf_counter()
+        board.unmake()
+        timings['make'] += perf_counter() - start
+    return nodes
+
+
+def run(name, fen, expected, depth, phases=False):
+    """ (bool) Runs one position to depth, prints its line of the report and whether it matched """
+    board, side = load_position(fen)
+    timings = dict.fromkeys(PHASES, 0.0)
+
+    start = perf_counter()
+    if phases:
+        nodes = profile(board, side, depth, timings)
+    else:
+        nodes = perft(board, side, depth)
+    elapsed = perf_counter() - start
+
+    known = expected[depth - 1] if depth <= len(expected) else None
+    if known is None:
+        status = '?'
+    elif known == nodes:
+        status = 'ok'
+    else:
+        status = f'FAIL (expected {known})'
+
+    rate = nodes / elapsed if elapsed else 0
+    line = f'{name:<10} depth {depth}  {nodes:>10} nodes  {elapsed:7.2f}s  {rate:>9.0f} nodes/s  {status}'
+    if phases:
+        line += '  ' + '  '.join(f'{phase} {timings[phase]:.2f}s' for phase in PHASES)
+    print(line)
+
+    return known is None or known == nodes
+
+
+def run_suite(depth=DEFAULT_DEPTH, names=None, phases=False):
+    """ (bool) Runs every known position (or just names) to depth, True if all counts matched """
+    passed = True
+    for name, fen, expected in POSITIONS:
+        if names and name not in names:
+            continue
+        passed = run(name, fen, expected, min(depth, len(expected)), phases=phases) and passed
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Perft correctness and speed check for chess.model')
+    parser.add_argument('-d', '--depth', type=int, default=DEFAULT_DEPTH)
+    parser.add_argument('-p', '--position', action='append', choices=[name for name, _, _ in POSITIONS],
+                        help='only run this position, can be repeated')
+    parser.add_argument('--fen', help='run a custom position instead of the suite')
+    parser.add_argument('--divide', action='store_true',
+                        help='print the count below each root move of --fen (or the start position)')
+    parser.add_argument('--phases', action='store_true', help='time generation, make and check tests')
+    args = parser.parse_args()
+
+    if args.divide:
+        board, side = load_position(args.fen or POSITIONS[0][1])
+        counts = divide(board, side, args.depth)
+        for (from_position, to_position, promotion), count in counts.items():
+            print(from_position, to_position, promotion or '', count)
+        print('total', sum(counts.values()))
+        return
+
+    if args.fen is not None:
+        run('custom', args.fen, (), args.depth, phases=args.phases)
+        return
+
+    # a failing count exits non zero so this can run as a regression check
+    if not run_suite(args.depth, args.position, phases=args.phases):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
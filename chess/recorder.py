@@ -0,0 +1,342 @@
+# Recording games to disk and reading them back.
+# A GameRecorder appends every move of a ChessGame to an archive from a
+# background thread, as PGN or as a compact binary move log, and read_games
+# scans archives lazily so thousands of games can be replayed in one batch.
+import argparse
+import datetime
+import os
+import queue
+import re
+import struct
+import threading
+from time import perf_counter
+
+from model import *
+
+RESULTS = ('*', '1-0', '0-1', '1/2-1/2')
+RESULT_WIDTH = max(map(len, RESULTS))
+PGN_WIDTH = 79 # longest movetext line in PGN export format
+
+# binary archives hold each game as a Board.to_bytes start position, one
+# MOVE_FORMAT word per move (from | to << 6 | (promotion + 1) << 12) and
+# GAME_END followed by the index of the result in RESULTS
+MOVE_FORMAT = struct.Struct('<H')
+GAME_END = 0xffff
+
+_TAG = re.compile(r'\[(\w+)\s+"(.*)"\]')
+_MOVE_NUMBER = re.compile(r'\d+\.+')
+
+
+def is_pgn(path):
+    """ (bool) Whether path is a PGN archive rather than a binary one, going by its extension """
+    return path.lower().endswith('.pgn')
+
+
+def encode_move(move):
+    """ (int) The 16 bit binary archive word for move """
+    from_position, to_position, promotion = move
+    word = Board.position_to_index(from_position) | Board.position_to_index(to_position) << 6
+    if promotion is not None:
+        word |= (promotion + 1) << 12
+    return word
+
+
+def decode_move(word):
+    """ (Tuple) The move stored in a binary archive word """
+    promotion = (word >> 12) - 1
+    return POSITIONS[word & 63], POSITIONS[word >> 6 & 63], None if promotion < 0 else promotion
+
+
+class GameRecorder(object):
+    """ Streams games into an archive file without blocking the caller.
+
+    Moves are queued and written by a background thread through a buffered
+    file, and each game is fsynced once it ends. A takeback truncates the
+    file back to where the last move started, so the archive only ever holds
+    the moves that stand. Files ending in .pgn are written as PGN, anything
+    else as a binary move log. A PGN game's Result tag is written as '*'
+    padded to fit any result, and filled in when the game finishes.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._pgn = is_pgn(path)
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def start_game(self, board, white='?', black='?', event='?'):
+        """ Begins a new game from a copy of board between the named players """
+        headers = {
+            'Event': event,
+            'Site': '?',
+            'Date': datetime.date.today().strftime('%Y.%m.%d'),
+            'Round': '?',
+            'White': white,
+            'Black': black,
+            # the result is only known at the end, finish fills it in
+            'Result': '*',
+        }
+        if board.to_fen() != START_FEN:
+            headers['SetUp'] = '1'
+            headers['FEN'] = board.to_fen()
+        self._queue.put(('start', board.copy(), headers))
+
+    def record(self, move):
+        """ Appends a (from, to, promotion) move to the current game """
+        self._queue.put(('move', move))
+
+    def take_back(self):
+        """ Removes the last recorded move of the current game """
+        self._queue.put(('take_back',))
+
+    def finish(self, result='*'):
+        """ Ends the current game with one of RESULTS and makes sure it is on disk """
+        self._queue.put(('finish', result))
+
+    def close(self):
+        """ Waits for everything queued to be written, then closes the archive """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        try:
+            # not opened for appending, which would stop finish going back to the Result tag
+            open(self._path, 'ab').close()
+            with open(self._path, 'r+b') as archive:
+                archive.seek(0, os.SEEK_END)
+                self._write_all(archive)
+        except OSError as error:
+            self._error = error
+            # keep draining so callers never block on a dead writer
+            while self._queue.get() is not None:
+                pass
+
+    def _write_all(self, archive):
+        board = None
+        starts = [] # (file offset, column) where each move of the current game starts
+        column = 0
+        result_offset = None # where the current PGN game's Result tag starts
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            action = item[0]
+
+            if action == 'start':
+                _, board, headers = item
+                starts = []
+                column = 0
+                if self._pgn:
+                    for name, value in headers.items():
+                        if name == 'Result':
+                            result_offset = archive.tell()
+                        archive.write(self._tag(name, value).encode())
+                    archive.write(b'\n')
+                else:
+                    archive.write(board.to_bytes())
+
+            elif board is None:
+                continue
+
+            elif action == 'move':
+                move = item[1]
+                starts.append((archive.tell(), column))
+                if self._pgn:
+                    san = board.move_to_san(move)
+                    if board.get_turn() == WHITE:
+                        token = f'{board.get_fullmove()}. {san}'
+                    elif not starts[:-1]:
+                        token = f'{board.get_fullmove()}... {san}'
+                    else:
+                        token = san
+                    column = self._write_token(archive, token, column)
+                else:
+                    archive.write(MOVE_FORMAT.pack(encode_move(move)))
+                board.make(*move)
+
+            elif action == 'take_back':
+                if starts:
+                    offset, column = starts.pop()
+                    archive.flush()
+                    archive.truncate(offset)
+                    archive.seek(offset)
+                    board.unmake()
+
+            elif action == 'finish':
+                result = item[1]
+                if self._pgn:
+                    self._write_token(archive, result, column)
+                    archive.write(b'\n\n')
+                    end = archive.tell()
+                    archive.seek(result_offset)
+                    archive.write(self._tag('Result', result).encode())
+                    archive.seek(end)
+                else:
+                    archive.write(MOVE_FORMAT.pack(GAME_END) + bytes([RESULTS.index(result)]))
+                archive.flush()
+                os.fsync(archive.fileno())
+                board = None
+
+    @staticmethod
+    def _tag(name, value):
+        # the Result tag always takes the same room, so the real result can be written over '*'
+        padding = ' ' * (RESULT_WIDTH - len(value)) if name == 'Result' else ''
+        return f'[{name} "{value}"]{padding}\n'
+
+    @staticmethod
+    def _write_token(archive, token, column):
+        # wrap movetext lines like PGN export format does
+        if column and column + 1 + len(token) > PGN_WIDTH:
+            archive.write(b'\n')
+            column = 0
+        elif column:
+            archive.write(b' ')
+            column += 1
+        archive.write(token.encode())
+        return column + len(token)
+
+
+class RecordedGame(object):
+    """ One game read back from an archive by read_games """
+
+    def __init__(self, headers, start, moves, result):
+        self._headers = headers
+        self._start = start # FEN of the starting position
+        self._moves = moves # SAN strings from PGN, (from, to, promotion) moves from binary logs
+        self._result = result
+
+    def get_headers(self):
+        return self._headers
+
+    def get_result(self):
+        return self._result
+
+    def get_start(self):
+        """ (str) FEN of the position the game started from """
+        return self._start
+
+    def get_move_count(self):
+        return len(self._moves)
+
+    def replay(self):
+        """ Yields each move of the game and the board right after it is played.
+
+        The same board is made in place for every move, so copy it to keep a
+        position. Raises ValueError at the first move that isn't legal.
+        """
+        board = Board.from_fen(self._start)
+        for ply, move in enumerate(self._moves):
+            side = board.get_turn()
+            if isinstance(move, str):
+                parsed = board.parse_move(move, side)
+            else:
+                parsed = move if move in board.legal_moves(side) else None
+            if parsed is None:
+                raise ValueError(f'illegal move {move!r} at ply {ply + 1}')
+
+            board.make(*parsed)
+            yield parsed, board
+
+
+def read_games(path):
+    """ Yields a RecordedGame for every game in an archive, reading it lazily """
+    if is_pgn(path):
+        return _read_pgn(path)
+    return _read_binary(path)
+
+
+def _read_pgn(path):
+    with open(path, encoding='utf-8', errors='replace') as archive:
+        headers, moves = {}, []
+        depth = 0 # inside comments or variations
+
+        for line in archive:
+            line = line.strip()
+            if depth == 0 and line.startswith('['):
+                match = _TAG.match(line)
+                if match:
+                    headers[match.group(1)] = match.group(2)
+                continue
+            if line.startswith('%'):
+                continue
+            if ';' in line and '{' not in line:
+                line = line[:line.index(';')]
+
+            for token in line.replace('(', ' ( ').replace(')', ' ) ').replace('{', ' { ').replace('}', ' } ').split():
+                if token in ('(', '{'):
+                    depth += 1
+                elif token in (')', '}'):
+                    depth -= 1
+                elif depth or token.startswith('$'):
+                    continue
+                elif token in RESULTS:
+                    yield RecordedGame(headers, headers.get('FEN', START_FEN), moves, token)
+                    headers, moves = {}, []
+                else:
+                    token = _MOVE_NUMBER.sub('', token)
+                    if token:
+                        moves.append(token)
+
+        # a game still being recorded has no termination yet
+        if moves:
+            yield RecordedGame(headers, headers.get('FEN', START_FEN), moves, '*')
+
+
+def _read_binary(path):
+    with open(path, 'rb') as archive:
+        while True:
+            start = archive.read(POSITION_SIZE)
+            if len(start) < POSITION_SIZE:
+                return
+
+            moves, result = [], '*'
+            while True:
+                data = archive.read(MOVE_FORMAT.size)
+                if len(data) < MOVE_FORMAT.size:
+                    break
+                word, = MOVE_FORMAT.unpack(data)
+                if word == GAME_END:
+                    result = RESULTS[archive.read(1)[0]]
+                    break
+                moves.append(decode_move(word))
+
+            yield RecordedGame({}, Board.from_bytes(start).to_fen(), moves, result)
+
+
+def validate(paths):
+    """ (Tuple<int, int, List<str>>) Games and moves replayed from the archives in paths, and any errors """
+    games = moves = 0
+    errors = []
+    for path in paths:
+        for number, game in enumerate(read_games(path), 1):
+            games += 1
+            try:
+                for _ in game.replay():
+                    moves += 1
+            except ValueError as error:
+                errors.append(f'{path} game {number}: {error}')
+    return games, moves, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay and check recorded game archives')
+    parser.add_argument('archives', nargs='+', help='.pgn files or binary move logs')
+    args = parser.parse_args()
+
+    start = perf_counter()
+    games, moves, errors = validate(args.archives)
+    elapsed = perf_counter() - start
+
+    for error in errors:
+        print(error)
+    rate = moves / elapsed if elapsed else 0
+    print(f'{games} games, {moves} moves replayed in {elapsed:.2f}s ({rate:.0f} moves/s), {len(errors)} invalid')
+
+
+if __name__ == '__main__':
+    main()
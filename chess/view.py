@@ -6,10 +6,97 @@ from PIL import Image, ImageTk
 NORMAL = 0
 FLIPPED = 1
 
+PIECES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pieces')
+SPRITE_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.sprites')
+
+
+class SpriteAtlas(object):
+    """ The piece images, resized once per cell size.
+
+    The source PNGs are decoded once and resized with Lanczos resampling. Each
+    cell size is saved to disk as a single strip image named after the size
+    and the newest source mtime, so later runs only decode that one file.
+    Strips and PhotoImages are kept in memory, so a size seen before is
+    instant.
+    """
+
+    def __init__(self, folder=PIECES_FOLDER, cache_folder=SPRITE_CACHE):
+        self._folder = folder
+        self._cache_folder = cache_folder
+        self._names = sorted(filename.split('.')[0] for filename in os.listdir(folder) if filename.endswith('.png'))
+        self._mtime = max(os.stat(self.source_path(name)).st_mtime_ns for name in self._names)
+        self._sources = None # decoded source images, only needed when a size isn't cached
+        self._sprites = {} # cell size -> name -> PIL image
+        self._photos = {} # cell size -> name -> PhotoImage
+
+    def source_path(self, name):
+        return os.path.join(self._folder, name + '.png')
+
+    def cache_path(self, cell_size):
+        return os.path.join(self._cache_folder, f'{cell_size}_{self._mtime}.png')
+
+    def get_sprites(self, cell_size):
+        """ (Dict<str, Image>) Each piece image at cell_size, by name such as 'white_king' """
+        sprites = self._sprites.get(cell_size)
+        if sprites is None:
+            strip = self.load_strip(cell_size)
+            sprites = {name: strip.crop((i * cell_size, 0, (i + 1) * cell_size, cell_size))
+                       for i, name in enumerate(self._names)}
+            self._sprites[cell_size] = sprites
+        return sprites
+
+    def get_images(self, cell_size):
+        """ (Dict<str, PhotoImage>) get_sprites ready for a canvas, needs a Tk root """
+        photos = self._photos.get(cell_size)
+        if photos is None:
+            photos = {name: ImageTk.PhotoImage(sprite) for name, sprite in self.get_sprites(cell_size).items()}
+            self._photos[cell_size] = photos
+        return photos
+
+    def load_strip(self, cell_size):
+        """ (Image) Every sprite at cell_size side by side, from the disk cache if it is up to date """
+        path = self.cache_path(cell_size)
+        try:
+            with Image.open(path) as cached:
+                if cached.size == (cell_size * len(self._names), cell_size):
+                    return cached.convert('RGBA')
+        except OSError:
+            pass
+
+        if self._sources is None:
+            self._sources = {}
+            for name in self._names:
+                with Image.open(self.source_path(name)) as source:
+                    self._sources[name] = source.convert('RGBA')
+
+        strip = Image.new('RGBA', (cell_size * len(self._names), cell_size))
+        for i, name in enumerate(self._names):
+            strip.paste(self._sources[name].resize((cell_size, cell_size), Image.LANCZOS), (i * cell_size, 0))
+
+        # the cache is only a speed up, so a read only folder just means resizing every run
+        try:
+            os.makedirs(self._cache_folder, exist_ok=True)
+            for filename in os.listdir(self._cache_folder):
+                if filename.startswith(f'{cell_size}_'):
+                    os.remove(os.path.join(self._cache_folder, filename))
+            strip.save(path)
+        except OSError:
+            pass
+        return strip
+
+
 class ChessView(tk.Canvas):
+    """ Draws a board onto a canvas.
+
+    Every square keeps the same rectangle and piece item for the life of the
+    view, keyed by board index. draw_board compares the new board's bitboards
+    and highlights with what is on screen and only reconfigures the squares
+    that changed, counting each canvas call in get_redraw_count.
+    """
 
     GRID_SIZE = 600
     BLACK_SQUARE = '#138c9e'
+    HIGHLIGHT = '#77a2b5'
 
     def __init__(self, master):
         super().__init__(master, height=self.GRID_SIZE, width=self.GRID_SIZE)
@@ -17,25 +104,102 @@ class ChessView(tk.Canvas):
         self._cell_size = self.GRID_SIZE // 8
         self._orientation = NORMAL
 
-    def draw_board(self, board):
-        self.delete(tk.ALL)
-        for index, piece in enumerate(board.get_board()):
-            x, y = self.normalise_position((index % 8, index // 8))
-
-            # create the rectangle
-            colour = 'white' if (x + y) % 2 == 0 else self.BLACK_SQUARE
-            self.create_rectangle(self.bbox((x, y)), fill=colour)
-
-            # draw the piece if needed
-            self.draw_piece(piece, (x, y))
-
-    def draw_piece(self, piece, position):
-        x, y = position
-        colour = 'white' if (x + y) % 2 == 0 else 'black'
-
-        if piece is not None:
-            fg = '#000' if colour == 'white' else '#fff'
-            self.create_text(self.center((x, y)), text=str(piece), fill=fg)
+        self._items = [] # (rectangle, piece item) for each board index
+        self._fills = [None] * 64 # colour currently shown on each square
+        self._board = None # copy of the board last drawn, games make their moves on the board in place
+        self._highlighted = {} # index -> fill of each highlighted square
+        self._redraws = 0
+
+    def get_redraw_count(self):
+        """ (int) Canvas items created, reconfigured or moved since the last reset """
+        return self._redraws
+
+    def reset_redraw_count(self):
+        self._redraws = 0
+
+    def draw_board(self, board, highlighted=(), fill=HIGHLIGHT):
+        """ Shows board with the squares in highlighted filled with fill """
+        self.update_squares(board, {Board.position_to_index(position): fill for position in highlighted})
+
+    def highlight_squares(self, squares, board, fill=HIGHLIGHT):
+        """ Adds squares to the highlights already shown """
+        highlighted = dict(self._highlighted)
+        highlighted.update((Board.position_to_index(position), fill) for position in squares)
+        self.update_squares(board, highlighted)
+
+    def update_squares(self, board, highlighted):
+        """ Brings the canvas in line with board and the index -> fill highlights """
+        if not self._items:
+            self.create_squares()
+
+        # squares whose piece changed show up in the xor of the old and new bitboards
+        if self._board is None:
+            changed = board.get_occupancy() # piece items start out empty
+        else:
+            changed = 0
+            for side in (WHITE, BLACK):
+                for kind in range(KINDS):
+                    changed |= board.get_bitboard(side, kind) ^ self._board.get_bitboard(side, kind)
+        self._board = board.copy()
+
+        while changed:
+            bit = changed & -changed
+            changed ^= bit
+            index = bit.bit_length() - 1
+            self.show_piece(self._items[index][1], board.get_piece(Board.index_to_position(index)))
+            self._redraws += 1
+
+        for index in set(self._highlighted) | set(highlighted):
+            self.fill_square(index, highlighted.get(index, self.square_colour(index)))
+        self._highlighted = highlighted
+
+    def create_squares(self):
+        """ Creates the rectangle and an empty piece item for every square """
+        for index in range(64):
+            position = self.normalise_position(Board.index_to_position(index))
+            colour = self.square_colour(index)
+            rectangle = self.create_rectangle(self.bbox(position), fill=colour)
+            self._items.append((rectangle, self.create_piece_item(index, position)))
+            self._fills[index] = colour
+            self._redraws += 2
+
+    def fill_square(self, index, colour):
+        if self._fills[index] != colour:
+            self.itemconfig(self._items[index][0], fill=colour)
+            self._fills[index] = colour
+            self._redraws += 1
+
+    def square_colour(self, index):
+        # a1 is a dark square whichever way round the board is drawn
+        x, y = Board.index_to_position(index)
+        return 'white' if (x + y) % 2 == 1 else self.BLACK_SQUARE
+
+    def create_piece_item(self, index, position):
+        """ (int) A canvas item on position, showing no piece yet """
+        fg = '#000' if self.square_colour(index) == 'white' else '#fff'
+        return self.create_text(self.center(position), text='', fill=fg)
+
+    def show_piece(self, item, piece):
+        """ Makes item show piece, or nothing if piece is None """
+        self.itemconfig(item, text='' if piece is None else str(piece))
+
+    def set_orientation(self, orientation):
+        """ Flips the board between NORMAL and FLIPPED by moving the existing items """
+        self._orientation = orientation
+        self.place_squares()
+
+    def resize(self, cell_size):
+        """ Changes the size of each square, moving the existing items """
+        self._cell_size = cell_size
+        self.config(height=cell_size * 8, width=cell_size * 8)
+        self.place_squares()
+
+    def place_squares(self):
+        for index, (rectangle, piece_item) in enumerate(self._items):
+            position = self.normalise_position(Board.index_to_position(index))
+            self.coords(rectangle, *self.bbox(position))
+            self.coords(piece_item, *self.center(position))
+            self._redraws += 2
 
     def normalise_position(self, position):
         # normalises the position based on the current orientation
@@ -44,16 +208,6 @@ class ChessView(tk.Canvas):
             return x, 7 - y
 
         return x, y
-
-    def highlight_squares(self, squares, board, fill='#77a2b5'):
-        for position in squares:
-            x, y = self.normalise_position(position)
-
-            self.create_rectangle(self.bbox((x, y)), fill=fill)
-
-            # draw piece back on
-            piece = board.get_piece(position)
-            self.draw_piece(piece, (x, y))
     
     def bbox(self, position):
         x, y = position
@@ -72,23 +226,32 @@ class ChessView(tk.Canvas):
 
 class ImageChessView(ChessView):
 
-    def __init__(self, master):
+    def __init__(self, master, atlas=None):
         super().__init__(master)
+        self._atlas = SpriteAtlas() if atlas is None else atlas
         self._images = {}
         self.load_images()
 
     def load_images(self):
-        folder = 'pieces'
-        for filename in os.listdir(folder):
-            path = os.path.join(folder, filename)
-            image = Image.open(path).resize((self._cell_size, self._cell_size))
-            photo = ImageTk.PhotoImage(image)
-            
-            name = filename.split('.')[0]
-            self._images[name] = photo
-
-    def draw_piece(self, piece, position):
+        self._images = self._atlas.get_images(self._cell_size)
+
+    def resize(self, cell_size):
+        super().resize(cell_size)
+        self.load_images()
+
+        # every piece item still points at an image of the old size
+        if self._board is not None:
+            for index, piece in enumerate(self._board.get_board()):
+                if piece is not None:
+                    self.show_piece(self._items[index][1], piece)
+                    self._redraws += 1
+
+    def create_piece_item(self, index, position):
+        return self.create_image(self.center(position), image='')
+
+    def show_piece(self, item, piece):
         if piece is None:
+            self.itemconfig(item, image='')
             return
 
         if piece.get_side() == WHITE:
@@ -97,7 +260,7 @@ class ImageChessView(ChessView):
             identifier = 'black'
         
         identifier += '_' + piece.__class__.__name__.lower()
-        self.create_image(self.center(position), image=self._images[identifier])
+        self.itemconfig(item, image=self._images[identifier])
 
         
 
@@ -111,6 +274,9 @@ class InfoBar(tk.Frame):
         self._selected_label = tk.Label(self, text='?')
         self._selected_label.pack(side=tk.TOP)
 
+        self._clock_label = tk.Label(self, text='')
+        self._clock_label.pack(side=tk.TOP)
+
     def set_turn(self, turn):
         if turn == WHITE:
             self._turn_label.config(text='WHITE')
@@ -123,8 +289,39 @@ class InfoBar(tk.Frame):
         else:
             self._selected_label.config(text=str(position))
 
+    def set_clock(self, clock):
+        """ Shows the time each side has left on clock (a ChessClock) as of now """
+        if clock is None:
+            self._clock_label.config(text='')
+            return
+
+        times = []
+        for side, name in ((WHITE, 'WHITE'), (BLACK, 'BLACK')):
+            seconds = clock.get_remaining(side)
+            text = f'{name} {int(seconds) // 60}:{int(seconds) % 60:02d}'
+            if clock.has_flagged(side):
+                text += ' (flagged)'
+            elif clock.get_running() == side:
+                text += ' *'
+            times.append(text)
+        self._clock_label.config(text='   '.join(times))
+
 
 
+def test_redraw():
+    # the game makes moves on the board the view last drew, which must still show up
+    root = tk.Tk()
+    view = ChessView(root)
+    game = ChessGame(Player('white', 60), Player('black', 60), board=Board.from_fen(START_FEN))
+    view.draw_board(game.get_board())
+
+    view.reset_redraw_count()
+    game.attempt_move(WHITE, (4, 1), (4, 3))
+    view.draw_board(game.get_board())
+    assert view.get_redraw_count() == 2, view.get_redraw_count()
+    print('e2e4 redrew', view.get_redraw_count(), 'squares')
+    root.destroy()
+
 def main():
     root = tk.Tk()
 
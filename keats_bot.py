@@ -1,6 +1,8 @@
 from twitchio.ext import commands
-from requesters import RequestMuxer, SoundRequester
+from requesters import ChessVoteRequester, RequestMuxer, SoundRequester
+from chess.model import BLACK, START_FEN, Board, ChessGame, Player
 
+import asyncio
 import os
 
 class KeatsBot(commands.Bot):
@@ -13,14 +15,18 @@ class KeatsBot(commands.Bot):
 
     DISCORD = 'https://discord.gg/eBvGYfJ'
     SOUND = 'sound'
+    CHESS = 'chess'
+    VOTE_WINDOW = 30 # seconds chat has to vote for each of its moves
+    CHESS_TIME = 600
 
     def __init__(self):
         super().__init__(irc_token=self.TOKEN, client_id=self.CLIENT_ID, nick=self.CLIENT_ID, prefix='!',
                          initial_channels=self.CHANNELS)
 
-        # add the models in
+        # add the models in, sounds are the only costly requests and SoundRequester limits its own rate
         self._requests = RequestMuxer()
         self._requests.add_requester(SOUND, SoundRequester(sound_file='sounds/soundfile', sound_folder='sounds'))
+        self._votes = None # task running chat's voting windows while a chess game is on
 
     def get_model(self):
         return self._requests
@@ -47,6 +53,60 @@ class KeatsBot(commands.Bot):
         message = ctx.content.split('play', 1)[1].lower().strip() # get request stripped and lowercased.
         self._model.make_request(SOUND, ctx.author.name, message)
 
+    def is_owner(self, ctx):
+        return ctx.author.name.lower() == self.OWNER.lower()
+
+    @commands.command(name='chess')
+    async def chess(self, ctx):
+        # the owner plays white against chat, replacing any game already going
+        if not self.is_owner(ctx):
+            return
+
+        game = ChessGame(Player(self.OWNER, self.CHESS_TIME), Player('chat', self.CHESS_TIME),
+                         board=Board.from_fen(START_FEN))
+        requester = ChessVoteRequester(game, side=BLACK)
+        self._requests.add_requester(self.CHESS, requester)
+        if self._votes is not None:
+            self._votes.cancel()
+        self._votes = asyncio.ensure_future(self.run_votes(ctx, requester))
+        await ctx.send(f'{self.OWNER} plays white against chat, vote for black\'s moves with !move')
+
+    async def run_votes(self, ctx, requester):
+        """ Opens a voting window each time it's chat's turn and plays the winner when it closes """
+        game = requester.get_game()
+        while game.get_legal_moves():
+            if game.get_turn() != requester.get_side():
+                await asyncio.sleep(1)
+                continue
+
+            requester.open_window()
+            await ctx.send(f'Chat to move, {self.VOTE_WINDOW}s to vote with !move')
+            await asyncio.sleep(self.VOTE_WINDOW)
+            winner = requester.close_window()
+            if winner is None:
+                await ctx.send('Nobody voted for a legal move, voting again')
+            else:
+                await ctx.send(f'Chat plays {Board.move_to_uci(winner)}')
+        await ctx.send('Game over')
+
+    @commands.command(name='move')
+    async def move(self, ctx):
+        # only once !chess has added a ChessVoteRequester under CHESS
+        requester = self._requests.get_requester(self.CHESS)
+        if requester is None:
+            return
+
+        message = ctx.content.split('move', 1)[1].strip() # move notation is case sensitive
+        game = requester.get_game()
+        side = game.get_turn()
+        if self.is_owner(ctx) and side != requester.get_side():
+            move = game.get_board().parse_move(message, side)
+            if move is not None:
+                game.attempt_move(side, *move)
+            return
+
+        self._requests.make_request(self.CHESS, ctx.author.name, message)
+
     @commands.command(name='help')
     async def help(self, ctx):
         response = 'https://docs.google.com/document/d/16SJbn_19oA3_gIh8CC3e2zrfSKOo8S_LztY64qwTHN8/edit?usp=sharing'
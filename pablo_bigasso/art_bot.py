@@ -10,6 +10,7 @@ import os
 IMAGE = 'image'
 SOUND = 'sound'
 TIME = 'time'
+REQUEST_JOURNAL = 'image_requests' # requests are kept in its .snapshot and .journal files
 
 class ArtBot(KeatsBot):
 
@@ -17,7 +18,7 @@ class ArtBot(KeatsBot):
         super().__init__()
 
         # add the models in
-        self._requests.add_requester(IMAGE, ImageRequester())
+        self._requests.add_requester(IMAGE, ImageRequester(journal=REQUEST_JOURNAL))
         self._requests.add_requester(TIME, TimeRequester())
 
         self._view = None
@@ -42,7 +43,11 @@ class ArtBot(KeatsBot):
         message = ctx.content.split('rate', 1)[-1].strip() # get request stripped
         model = self._model.get_requester(TIME)
         user = ctx.author.name
-        if model.can_request(user) and self._view is not None:
+        if self._view is None:
+            return
+
+        # only an admitted request puts the player in timeout, so only it may change the time
+        if model.request(user, message) == ADMITTED:
             modifiers = {
                 "StinkyCheese": -10,
                 "CurseLit": 10
@@ -50,8 +55,6 @@ class ArtBot(KeatsBot):
             for key in modifiers:
                 if key in message:
                     self._view.change_time(modifiers[key])
-
-            model.request(user, message) # add player to timeout for a little while
     
     @commands.command(name='help')
     async def help(self, ctx):
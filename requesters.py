@@ -1,26 +1,668 @@
 import random
-from datetime import datetime, timedelta
+from datetime import timedelta
 import os
-import winsound
 
-import pickle
-from time import sleep
+import heapq
+import re
+import struct
+import threading
+import unicodedata
+import wave
+import zlib
+from time import monotonic, sleep
+
+from audio import Sound, SoundPlayer
+from chess.model import BLACK, normalise_notation
+
+# why Requester.request did or didn't run a request
+ADMITTED = 'admitted'
+NOT_ACCEPTING = 'not_accepting'
+COOLDOWN = 'cooldown'
+USER_LIMIT = 'user_limit'
+COMMAND_LIMIT = 'command_limit'
+REQUESTER_LIMIT = 'requester_limit'
+GLOBAL_LIMIT = 'global_limit'
+UNKNOWN_REQUESTER = 'unknown_requester'
+
+# image request snapshots: magic and prompt count, then for each prompt its
+# length and the length of its users joined by newlines, followed by both
+SNAPSHOT_MAGIC = b'IRQ1'
+SNAPSHOT_HEADER = struct.Struct('<4sI')
+SNAPSHOT_PROMPT = struct.Struct('<HI')
+
+# image request journal records: crc32 of the rest, operation, prompt and user lengths, then both
+RECORD_HEADER = struct.Struct('<IBHH')
+VOTE, REMOVE, CLEAR = range(3)
+COMPACT_BYTES = 1 << 20 # journal size that triggers a snapshot
+
+# prompts this similar after normalising count as the same request: up to one
+# typo (insertion, deletion, substitution or swapped letters) per TYPO_LENGTH characters
+TYPO_LENGTH = 12
+MAX_PROMPT_LENGTH = 200 # characters of a normalised prompt compared, which bounds the work per comparison
+_NOT_WORD = re.compile(r'[\W_]+')
+
+
+class TokenBucket(object):
+    """ Allows rate requests a second on average, in bursts of up to burst """
+
+    def __init__(self, rate, burst, now=None):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = monotonic() if now is None else now
+
+    def is_full(self, now):
+        return self._tokens + (now - self._updated) * self._rate >= self._burst
+
+    def is_ready(self, now):
+        """ (bool) Whether a request could be let through at now """
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        return self._tokens >= 1
+
+    def take(self, now):
+        if self.is_ready(now):
+            self._tokens -= 1
+
+
+class KeyedBuckets(object):
+    """ One TokenBucket per key (a user or a command), made on first use.
+
+    A bucket that has filled back up is the same as a new one, so full
+    buckets are dropped whenever the number kept doubles. That keeps memory
+    to the keys active lately, at an amortised O(1) per request.
+    """
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._buckets = {}
+        self._prune_at = 64
+
+    def is_ready(self, key, now):
+        bucket = self._buckets.get(key)
+        return bucket is None or bucket.is_ready(now)
+
+    def take(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self._rate, self._burst, now)
+        bucket.take(now)
+
+        if len(self._buckets) >= self._prune_at:
+            self._buckets = {key: bucket for key, bucket in self._buckets.items() if not bucket.is_full(now)}
+            self._prune_at = max(64, 2 * len(self._buckets))
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class WeightedSampler(object):
+    """ Keys with whole number weights, drawn at random in proportion to them.
+
+    Each key owns a slot of a Fenwick tree of weights, so changing a weight,
+    removing a key and drawing one are all O(log n). Freed slots go on a free
+    list and are reused by later keys, so the tree only grows with the
+    number of keys held at once.
+    """
+
+    def __init__(self):
+        self._tree = [0] # 1 indexed partial sums
+        self._weights = [0]
+        self._keys = [None]
+        self._slots = {} # key -> slot
+        self._free = []
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def get_total(self):
+        return self._prefix(len(self._tree) - 1)
+
+    def get_weight(self, key):
+        slot = self._slots.get(key)
+        return 0 if slot is None else self._weights[slot]
+
+    def _prefix(self, slot):
+        total = 0
+        while slot > 0:
+            total += self._tree[slot]
+            slot &= slot - 1
+        return total
+
+    def _update(self, slot, delta):
+        self._weights[slot] += delta
+        size = len(self._tree)
+        while slot < size:
+            self._tree[slot] += delta
+            slot += slot & -slot
+
+    def _new_slot(self, key):
+        if self._free:
+            slot = self._free.pop()
+        else:
+            # a new last slot covers the sums of the slots below it that it is responsible for
+            slot = len(self._tree)
+            self._tree.append(self._prefix(slot - 1) - self._prefix(slot - (slot & -slot)))
+            self._weights.append(0)
+            self._keys.append(None)
+        self._keys[slot] = key
+        self._slots[key] = slot
+        return slot
+
+    def add(self, key, weight=1):
+        """ Adds weight to key, adding the key if it's new """
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._new_slot(key)
+        self._update(slot, weight)
+
+    def set_weight(self, key, weight):
+        self.add(key, weight - self.get_weight(key))
+
+    def remove(self, key):
+        """ Removes key, returning its weight (0 if it wasn't there) """
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            return 0
+        weight = self._weights[slot]
+        self._update(slot, -weight)
+        self._keys[slot] = None
+        self._free.append(slot)
+        return weight
+
+    def clear(self):
+        self.__init__()
+
+    def sample(self, rng=random):
+        """ A key drawn in proportion to its weight, or None if every weight is 0 """
+        total = self.get_total()
+        if total <= 0:
+            return None
+
+        # walk down the tree to the slot whose running sum first passes target
+        target = rng.randrange(total)
+        slot = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            following = slot + step
+            if following < len(self._tree) and self._tree[following] <= target:
+                slot = following
+                target -= self._tree[following]
+            step >>= 1
+        return self._keys[slot + 1]
+
+    def sample_many(self, count, rng=random):
+        """ (List) Up to count different keys drawn by weight, without replacement """
+        drawn = []
+        for _ in range(count):
+            key = self.sample(rng)
+            if key is None:
+                break
+            drawn.append((key, self.remove(key)))
+
+        for key, weight in drawn:
+            self.add(key, weight)
+        return [key for key, _ in drawn]
+
+
+def normalise_prompt(text):
+    """ (str) text without case, accents, punctuation or repeated spaces, so 'A  Café!' is 'a cafe' """
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(character for character in text if not unicodedata.combining(character))
+    return _NOT_WORD.sub(' ', text.casefold()).strip()
+
+
+def trigrams(text):
+    """ (Set<str>) The three letter pieces of text, padded so its first and last letters get their own """
+    padded = f'  {text} '
+    return {padded[start:start + 3] for start in range(len(padded) - 2)}
+
+
+def within_edits(first, second, limit):
+    """ (bool) Whether first can be made into second with at most limit insertions, deletions,
+    substitutions and swaps of neighbouring letters """
+    if abs(len(first) - len(second)) > limit:
+        return False
+
+    # a typo is usually in one place, so the letters either side of it need no table
+    start = 0
+    while start < len(first) and start < len(second) and first[start] == second[start]:
+        start += 1
+    end = 0
+    while end < len(first) - start and end < len(second) - start and first[-1 - end] == second[-1 - end]:
+        end += 1
+    first, second = first[start:len(first) - end], second[start:len(second) - end]
+
+    # optimal string alignment distance a row at a time, only near the diagonal since cells
+    # further than limit from it are over limit anyway, stopping once a whole row is
+    over = limit + 1
+    before, previous = None, [min(column, over) for column in range(len(second) + 1)]
+    for row in range(1, len(first) + 1):
+        current = [over] * (len(second) + 1)
+        if row <= limit:
+            current[0] = row
+        for column in range(max(1, row - limit), min(len(second), row + limit) + 1):
+            cost = first[row - 1] != second[column - 1]
+            distance = min(previous[column] + 1, current[column - 1] + 1, previous[column - 1] + cost)
+            if (row > 1 and column > 1 and first[row - 1] == second[column - 2]
+                    and first[row - 2] == second[column - 1]):
+                distance = min(distance, before[column - 2] + 1)
+            current[column] = min(distance, over)
+        if min(current) > limit:
+            return False
+        before, previous = previous, current
+    return previous[-1] <= limit
+
+
+class PromptIndex(object):
+    """ Finds the prompt already held that a new one is a near duplicate of.
+
+    Keys are indexed by the trigrams of their normalised text. Each typo
+    changes at most four trigrams (swapping two letters touches the four that
+    overlap them, any other typo three), so a match within k typos shares all
+    but 4k of the new prompt's trigrams, and so has at least one of any
+    4k + 1 of them. Postings are split by text length, and candidates only
+    come from the postings of its 4k + 1 rarest trigrams in each length
+    within k of the new prompt's, which skips the common trigrams nearly
+    every prompt has. Only candidates sharing enough trigrams are checked letter by letter.
+    Texts are cut to MAX_PROMPT_LENGTH characters, both when added and when
+    looked up, so each check is bounded. Short prompts allow no typos and
+    only match once normalised.
+
+    Adding a key only normalises it. The postings of a text length are built
+    the first time a lookup needs them, so loading many prompts is quick
+    and lengths nobody comes near are never indexed.
+    """
+
+    def __init__(self, typo_length=TYPO_LENGTH):
+        self._typo_length = typo_length
+        self._texts = {} # key -> normalised text
+        self._grams = {} # key -> trigrams of its text, once its length is built
+        self._exact = {} # normalised text -> keys with it, the first is the one matched
+        self._buckets = {} # text length -> trigram -> keys, once built
+        self._pending = {} # text length -> keys added since, for lengths not built yet
+
+    def __len__(self):
+        return len(self._texts)
+
+    def __contains__(self, key):
+        return key in self._texts
+
+    def add(self, key, text=None):
+        """ Indexes key under text (default the key itself), normalised """
+        self.remove(key)
+        text = normalise_prompt(key if text is None else text)[:MAX_PROMPT_LENGTH]
+        self._texts[key] = text
+        self._exact.setdefault(text, []).append(key)
+
+        bucket = self._buckets.get(len(text))
+        if bucket is None:
+            self._pending.setdefault(len(text), set()).add(key)
+        else:
+            self._index(bucket, key, text)
+
+    def _index(self, bucket, key, text):
+        self._grams[key] = grams = trigrams(text)
+        for trigram in grams:
+            bucket.setdefault(trigram, set()).add(key)
+
+    def remove(self, key):
+        text = self._texts.pop(key, None)
+        if text is None:
+            return
+        keys = self._exact[text]
+        keys.remove(key)
+        if not keys:
+            del self._exact[text]
+
+        pending = self._pending.get(len(text))
+        if pending is not None:
+            pending.discard(key)
+            if not pending:
+                del self._pending[len(text)]
+
+        grams = self._grams.pop(key, None)
+        if grams is not None:
+            bucket = self._buckets[len(text)]
+            for trigram in grams:
+                keys = bucket[trigram]
+                keys.discard(key)
+                if not keys:
+                    del bucket[trigram]
+
+    def clear(self):
+        self._texts.clear()
+        self._grams.clear()
+        self._exact.clear()
+        self._buckets.clear()
+        self._pending.clear()
+
+    def _bucket(self, length):
+        bucket = self._buckets.get(length)
+        if bucket is None:
+            bucket = self._buckets[length] = {}
+            for key in self._pending.pop(length, ()):
+                self._index(bucket, key, self._texts[key])
+        return bucket
+
+    def find(self, text):
+        """ The key whose text is closest to text within the allowed typos, or None """
+        text = normalise_prompt(text)[:MAX_PROMPT_LENGTH]
+        keys = self._exact.get(text)
+        if keys:
+            return keys[0]
+
+        limit = len(text) // self._typo_length
+        grams = trigrams(text)
+        needed = len(grams) - 4 * limit
+        if limit == 0 or needed <= 0:
+            return None
+
+        # every key of a length shares one of any 4k + 1 trigrams, so each length can use its own rarest
+        candidates = set()
+        for length in range(len(text) - limit, len(text) + limit + 1):
+            bucket = self._bucket(length)
+            for trigram in sorted(grams, key=lambda trigram: len(bucket.get(trigram, ())))[:4 * limit + 1]:
+                candidates.update(bucket.get(trigram, ()))
+
+        # the candidates sharing most trigrams are the likeliest to be within the typos
+        shared = [(len(grams & self._grams[key]), key) for key in candidates]
+        shared.sort(key=lambda found: found[0], reverse=True)
+        for count, key in shared:
+            if count < needed:
+                break
+            if within_edits(text, self._texts[key], limit):
+                return key
+        return None
+
+
+def pack_requests(requests):
+    """ (bytes) A prompt -> users dict in the snapshot format """
+    parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(requests))]
+    for prompt, users in requests.items():
+        prompt = prompt.encode()
+        users = '\n'.join(users).encode()
+        parts.append(SNAPSHOT_PROMPT.pack(len(prompt), len(users)))
+        parts.append(prompt)
+        parts.append(users)
+    return b''.join(parts)
+
+
+def unpack_requests(data):
+    """ (Dict<str, Set<str>>) The requests in a snapshot made by pack_requests, raising ValueError if it isn't one """
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError('not an image request snapshot')
+
+    data = memoryview(data)
+    _, count = SNAPSHOT_HEADER.unpack_from(data)
+    offset = SNAPSHOT_HEADER.size
+    result = {}
+    for _ in range(count):
+        prompt_length, users_length = SNAPSHOT_PROMPT.unpack_from(data, offset)
+        offset += SNAPSHOT_PROMPT.size
+        prompt = bytes(data[offset:offset + prompt_length]).decode()
+        offset += prompt_length
+        users = bytes(data[offset:offset + users_length]).decode()
+        offset += users_length
+        result[prompt] = set(users.split('\n')) if users else set()
+    return result
+
+
+class RequestJournal(object):
+    """ Crash safe storage for ImageRequester: a snapshot plus a journal of changes since.
+
+    Every vote, removal and clear is appended to path.journal as a small
+    checksummed record and flushed straight away. Once the journal passes
+    COMPACT_BYTES it is set aside as path.journal.old, a new one is started
+    and the whole state is written to path.snapshot on a background thread,
+    after which the old journal is deleted. recover replays the snapshot,
+    then any old journal, then the journal up to the first torn record.
+    Replaying a record twice gives the same state, so a crash at any point
+    loses at most a record being written.
+    """
+
+    def __init__(self, path, compact_bytes=COMPACT_BYTES):
+        self._snapshot = path + '.snapshot'
+        self._journal_path = path + '.journal'
+        self._old_journal = path + '.journal.old'
+        self._compact_bytes = compact_bytes
+        self._journal = None
+        self._writer = None # thread writing the latest snapshot
+
+    def recover(self):
+        """ (Dict<str, Set<str>>) The requests as of the last record written """
+        requests = {}
+        if os.path.exists(self._snapshot):
+            with open(self._snapshot, 'rb') as snapshot:
+                requests = unpack_requests(snapshot.read())
+
+        for path in (self._old_journal, self._journal_path):
+            if os.path.exists(path):
+                with open(path, 'rb+') as journal:
+                    data = journal.read()
+                    end = self._replay(data, requests)
+                    # drop a torn record so new ones aren't appended after it
+                    if end < len(data):
+                        journal.truncate(end)
+
+        # a crash stopped the last snapshot, finish it before the next rotation replaces the old journal
+        if os.path.exists(self._old_journal):
+            self._write_snapshot(pack_requests(requests))
+
+        self._journal = open(self._journal_path, 'ab')
+        return requests
+
+    @staticmethod
+    def _replay(data, requests):
+        # returns where the valid records end
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            crc, operation, prompt_length, user_length = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + prompt_length + user_length
+            if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+                # a record cut short by a crash, nothing after it was written
+                return offset
+
+            prompt = data[end - prompt_length - user_length:end - user_length].decode()
+            if operation == VOTE:
+                requests.setdefault(prompt, set()).add(data[end - user_length:end].decode())
+            elif operation == REMOVE:
+                requests.pop(prompt, None)
+            elif operation == CLEAR:
+                requests.clear()
+            offset = end
+        return offset
+
+    def _append(self, operation, prompt='', user=''):
+        prompt, user = prompt.encode(), user.encode()
+        body = RECORD_HEADER.pack(0, operation, len(prompt), len(user))[4:] + prompt + user
+        self._journal.write(struct.pack('<I', zlib.crc32(body)) + body)
+        self._journal.flush()
+
+    def vote(self, prompt, user):
+        self._append(VOTE, prompt, user)
+
+    def remove(self, prompt):
+        self._append(REMOVE, prompt)
+
+    def clear(self):
+        self._append(CLEAR)
+
+    def needs_compacting(self):
+        return self._journal.tell() >= self._compact_bytes
+
+    def compact(self, requests):
+        """ Starts writing requests (the current state) as the new snapshot in the background """
+        self.wait()
+        data = pack_requests(requests)
+
+        self._journal.close()
+        os.replace(self._journal_path, self._old_journal)
+        self._journal = open(self._journal_path, 'ab')
+
+        self._writer = threading.Thread(target=self._write_snapshot, args=(data,), daemon=True)
+        self._writer.start()
+
+    def _write_snapshot(self, data):
+        temporary = self._snapshot + '.tmp'
+        with open(temporary, 'wb') as snapshot:
+            snapshot.write(data)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, self._snapshot)
+        os.remove(self._old_journal)
+
+    def wait(self):
+        """ Waits for a snapshot being written to finish """
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def close(self):
+        self.wait()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+class CooldownStore(object):
+    """ Remembers which users are cooling down, and only until they aren't.
+
+    Each user on cooldown maps to the monotonic time it ends, so a check is
+    one dict lookup. An expiry heap drops users whose cooldown is over as new
+    ones start, so the store only ever holds users from the last cooldown
+    period, and a zero cooldown stores nothing.
+    """
+
+    def __init__(self, cooldown=0, timer=monotonic):
+        self._cooldown = cooldown
+        self._timer = timer
+        self._expiries = {} # user -> time their cooldown ends
+        self._heap = [] # (time, user), may hold stale entries for users who were started again
+        self._checks = 0
+        self._hits = 0 # checks that found the user cooling down
+        self._expired = 0
+
+    def set_cooldown(self, seconds):
+        self._cooldown = seconds
+
+    def is_ready(self, user):
+        """ (bool) Whether user's cooldown is over """
+        self._checks += 1
+        expiry = self._expiries.get(user)
+        if expiry is not None and expiry > self._timer():
+            self._hits += 1
+            return False
+        return True
+
+    def start(self, user):
+        """ Puts user on cooldown from now """
+        now = self._timer()
+        self.expire(now)
+        if self._cooldown <= 0:
+            return
+
+        expiry = now + self._cooldown
+        self._expiries[user] = expiry
+        heapq.heappush(self._heap, (expiry, user))
+
+    def expire(self, now=None):
+        """ Forgets every user whose cooldown is over """
+        if now is None:
+            now = self._timer()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            expiry, user = heapq.heappop(heap)
+            if self._expiries.get(user) == expiry:
+                del self._expiries[user]
+                self._expired += 1
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def get_stats(self):
+        """ (Dict) Users cooling down, checks made, how many were on cooldown and the share that were """
+        return {
+            'size': len(self._expiries),
+            'checks': self._checks,
+            'hits': self._hits,
+            'hit_rate': self._hits / self._checks if self._checks else 0,
+            'expired': self._expired,
+        }
+
 
 # Base class for accepting user command requests.
 class Requester(object):
+    """ Runs chat commands through perform, unless a limit sheds them first.
+
+    A request has to get past, in order: accepting, the per-user cooldown and
+    the token buckets per user, per command, for this requester and shared
+    by every requester in a RequestMuxer. Buckets are only spent once all of
+    them allow the request. Each outcome is counted in get_load_stats.
+    """
     
     def __init__(self, time_limit=timedelta(seconds=0)):
-        self._time_limit = time_limit
         self._accepting = True
-        self._data = {}
+        self._cooldowns = CooldownStore(time_limit.total_seconds())
+        self._user_buckets = None
+        self._command_buckets = None
+        self._bucket = None
+        self._global_bucket = None
+        self._load = {}
 
     def can_request(self, user):
-        return datetime.now() - self._data.get(user, datetime.min) > self._time_limit
+        return self._cooldowns.is_ready(user)
+
+    def set_limits(self, per_user=None, per_command=None, per_requester=None):
+        """ Sets the (rate per second, burst) token bucket limits, None for no limit """
+        self._user_buckets = None if per_user is None else KeyedBuckets(*per_user)
+        self._command_buckets = None if per_command is None else KeyedBuckets(*per_command)
+        self._bucket = None if per_requester is None else TokenBucket(*per_requester)
+
+    def set_global_bucket(self, bucket):
+        self._global_bucket = bucket
+
+    def check(self, user, command, now):
+        """ (str) ADMITTED if a request would run now, otherwise the reason it would be shed """
+        if not self._accepting:
+            return NOT_ACCEPTING
+        if not self.can_request(user):
+            return COOLDOWN
+        if self._user_buckets is not None and not self._user_buckets.is_ready(user, now):
+            return USER_LIMIT
+        if self._command_buckets is not None and not self._command_buckets.is_ready(command, now):
+            return COMMAND_LIMIT
+        if self._bucket is not None and not self._bucket.is_ready(now):
+            return REQUESTER_LIMIT
+        if self._global_bucket is not None and not self._global_bucket.is_ready(now):
+            return GLOBAL_LIMIT
+        return ADMITTED
 
     def request(self, user, command):
-        if self._accepting and self.can_request(user):
-            self._data[user] = datetime.now()
-            self.perform(user, command)
+        """ (str) Performs command for user if nothing sheds it, returning ADMITTED or the reason """
+        now = monotonic()
+        reason = self.check(user, command, now)
+        self._load[reason] = self._load.get(reason, 0) + 1
+        if reason != ADMITTED:
+            return reason
+
+        self._cooldowns.start(user)
+        if self._user_buckets is not None:
+            self._user_buckets.take(user, now)
+        if self._command_buckets is not None:
+            self._command_buckets.take(command, now)
+        if self._bucket is not None:
+            self._bucket.take(now)
+        if self._global_bucket is not None:
+            self._global_bucket.take(now)
+
+        self.perform(user, command)
+        return reason
 
     def perform(self, user, command):
         raise NotImplementedError("Perform must be overridden in subclasses")
@@ -32,7 +674,14 @@ class Requester(object):
         return self._accepting
 
     def set_timeout(self, seconds):
-        self._time_limit = timedelta(seconds=seconds)
+        self._cooldowns.set_cooldown(seconds)
+
+    def get_cooldown_stats(self):
+        return self._cooldowns.get_stats()
+
+    def get_load_stats(self):
+        """ (Dict<str, int>) How many requests were admitted and how many were shed for each reason """
+        return dict(self._load)
 
 
 class TimeRequester(Requester):
@@ -45,12 +694,22 @@ class TimeRequester(Requester):
 
 
 class SoundRequester(Requester):
-    """ Allow users to request sound effects """
+    """ Allow users to request sound effects.
 
-    def __init__(self, sound_file, sound_folder):
+    Every sound is read into memory when the sound file is loaded, and
+    perform only queues it on a SoundPlayer, so playing never blocks the bot.
+    """
+
+    # however many people ask, a sound every few seconds at most
+    RATE_LIMIT = (0.3, 3)
+    SOUND_LIMIT = (0.1, 2)
+
+    def __init__(self, sound_file, sound_folder, player=None):
         super().__init__(time_limit=timedelta(seconds=30))
-        self._sounds = {}
+        self.set_limits(per_command=self.SOUND_LIMIT, per_requester=self.RATE_LIMIT)
+        self._sounds = {} # name -> Sound
         self._folder = sound_folder
+        self._player = SoundPlayer() if player is None else player
         self.load_sounds(sound_file)
 
     def load_sounds(self, file):
@@ -61,25 +720,81 @@ class SoundRequester(Requester):
                 name, path = line.split(':')
                 name = name.strip()
                 path = os.path.join(self._folder, path.strip())
-                self._sounds[name] = path
+                try:
+                    self._sounds[name] = Sound.from_file(name, path)
+                except (OSError, EOFError, wave.Error) as error:
+                    print(f'Could not load sound {name}: {error}')
+
+    def get_sounds(self):
+        return list(self._sounds)
+
+    def get_player(self):
+        return self._player
     
     def perform(self, user, command):
-        if command in self._sounds:
-            winsound.PlaySound(self._sounds[command], (winsound.SND_FILENAME | winsound.SND_NOSTOP))
+        sound = self._sounds.get(command)
+        if sound is not None:
+            self._player.play(sound)
+
+    def close(self):
+        """ Lets queued sounds finish, then stops the player """
+        self._player.close()
 
 
 class ImageRequester(Requester):
+    """ Collects prompts from chat, picking them at random weighted by how many people asked.
 
-    def __init__(self):
+    Given a journal path, requests survive crashes: they are recovered from
+    it on start and every change is journaled as it happens.
+    """
+
+    def __init__(self, journal=None):
         super().__init__()
         self._requests = {}
+        self._sampler = WeightedSampler() # prompt -> number of users asking for it
+        self._index = PromptIndex() # merges a prompt into one already asked for that it nearly matches
+        self._journal = None
+        if journal is not None:
+            self._journal = RequestJournal(journal)
+            self.set_requests(self._journal.recover())
+
+    def set_requests(self, requests):
+        """ Adds the prompt -> users requests, replacing the users of prompts already asked for """
+        self._requests.update(requests)
+        for request, users in requests.items():
+            self._sampler.set_weight(request, len(users))
+            self._index.add(request)
+
+    def find_request(self, command):
+        """ (str) The prompt already asked for that command is the same as or a near duplicate of, or None """
+        return self._index.find(command)
 
     def perform(self, user, command):
-        self._requests.setdefault(command, set())
-        self._requests[command].add(user)
+        # votes for 'A cat!' or 'a cta' go to 'a cat' if it was asked for first
+        match = self._index.find(command)
+        if match is None:
+            self._index.add(command)
+        else:
+            command = match
+
+        users = self._requests.setdefault(command, set())
+        if user not in users:
+            users.add(user)
+            self._sampler.add(command)
+            self._log(RequestJournal.vote, command, user)
+
+    def _log(self, change, *args):
+        if self._journal is None:
+            return
+        change(self._journal, *args)
+        if self._journal.needs_compacting():
+            self._journal.compact(self._requests)
 
     def clear_requests(self):
         self._requests.clear()
+        self._sampler.clear()
+        self._index.clear()
+        self._log(RequestJournal.clear)
 
     def get_requests(self):
         return self._requests
@@ -88,44 +803,168 @@ class ImageRequester(Requester):
         return self._requests.get(request, set())
 
     def save(self, filename):
+        # the snapshot format, which unlike pickle is safe to load from anywhere
         with open(filename, 'wb') as save_file:
-            pickle.dump(self._requests, save_file)
+            save_file.write(pack_requests(self._requests))
         
 
     def load(self, filename):
         with open(filename, 'rb') as load_file:
-            self._requests.update(pickle.load(load_file))
+            loaded = unpack_requests(load_file.read())
+        replaced = [request for request in loaded if request in self._requests]
+        self.set_requests(loaded)
+        # loaded users replace those of a prompt already asked for, rather than joining them
+        for request in replaced:
+            self._log(RequestJournal.remove, request)
+        for request, users in loaded.items():
+            for user in users:
+                self._log(RequestJournal.vote, request, user)
+
+    def _remove(self, request):
+        self._sampler.remove(request)
+        self._index.remove(request)
+        del self._requests[request]
+        self._log(RequestJournal.remove, request)
 
     def select_random_request(self):
-        converted = [(k, len(v)) for (k, v) in self._requests.items()]
-        if len(converted) == 0:
+        chosen = self._sampler.sample()
+        if chosen is None:
             return None
 
-        total = sum(v for (_, v) in converted)
-
-        chosen = random.choices(
-            [name for (name, _) in converted],
-            [v / total for (_, v) in converted],
-            k=1
-        )[0]
+        self._remove(chosen)
+        return chosen
 
-        del self._requests[chosen]
+    def select_random_requests(self, count):
+        """ (List<str>) Up to count different prompts drawn by votes and removed, like select_random_request """
+        chosen = self._sampler.sample_many(count)
+        for request in chosen:
+            self._remove(request)
         return chosen
 
+    def close(self):
+        """ Finishes any snapshot being written and closes the journal """
+        if self._journal is not None:
+            self._journal.close()
+
+
+class ChessVoteRequester(Requester):
+    """ Lets chat play one side of a ChessGame by voting for moves.
+
+    Votes are SAN or UCI ('e4', 'Nf3', 'e2e4'). They are looked up in a table
+    of every spelling of the legal moves, built once per position, and each
+    user's latest vote counts once. close_window plays the most voted move,
+    or the game's opening book move when nobody voted.
+    """
+
+    def __init__(self, game, side=BLACK, time_limit=timedelta(seconds=0)):
+        super().__init__(time_limit=time_limit)
+        self._game = game
+        self._side = side
+        self._votes = {} # user -> move
+        self._tally = {} # move -> number of votes
+        self._first_votes = {} # move -> order it was first voted for, breaks ties
+        self._notations = {}
+        self._notations_key = None
+        self.set_accepting(False)
+
+    def get_game(self):
+        return self._game
+
+    def get_side(self):
+        return self._side
+
+    def get_notations(self):
+        """ (Dict<str, Tuple>) Spellings of the legal moves in the current position, cached per position """
+        board = self._game.get_board()
+        key = board.get_hash()
+        if key != self._notations_key:
+            self._notations = board.move_notations(self._side)
+            self._notations_key = key
+        return self._notations
+
+    def open_window(self):
+        """ Starts accepting votes if it's chat's turn """
+        self.clear_votes()
+        self.get_notations()
+        self.set_accepting(self._game.get_turn() == self._side)
+
+    def perform(self, user, command):
+        move = self.get_notations().get(normalise_notation(command))
+        if move is None:
+            return
+
+        previous = self._votes.get(user)
+        if previous == move:
+            return
+        if previous is not None:
+            self._tally[previous] -= 1
+            if self._tally[previous] == 0:
+                del self._tally[previous]
+
+        self._votes[user] = move
+        self._tally[move] = self._tally.get(move, 0) + 1
+        self._first_votes.setdefault(move, len(self._first_votes))
+
+    def get_tally(self):
+        return self._tally
+
+    def get_winner(self):
+        """ (Tuple) The move with the most votes, earliest voted first on a tie, or None """
+        if not self._tally:
+            return None
+        return max(self._tally, key=lambda move: (self._tally[move], -self._first_votes[move]))
+
+    def clear_votes(self):
+        self._votes.clear()
+        self._tally.clear()
+        self._first_votes.clear()
+
+    def close_window(self):
+        """ (Tuple) Stops voting and plays the winning move, returning it (None if no move was found) """
+        self.set_accepting(False)
+        winner = self.get_winner()
+        self.clear_votes()
+
+        if winner is None and self._game.get_turn() == self._side:
+            winner = self._game.get_book_move(self._side)
+
+        if winner is not None:
+            self._game.attempt_move(self._side, *winner)
+        return winner
+
 
 class RequestMuxer(object):
 
-    def __init__(self):
+    def __init__(self, global_limit=None):
         self._requesters = {}
+        # one bucket shared by every requester, (rate per second, burst)
+        self._bucket = None if global_limit is None else TokenBucket(*global_limit)
+        self._unknown = 0
 
     def add_requester(self, name, requester):
+        requester.set_global_bucket(self._bucket)
         self._requesters[name] = requester
 
     def get_requester(self, name):
         return self._requesters.get(name, None)
 
     def make_request(self, request_type, user, command):
-        self._requesters.get(request_type).request(user, command)
+        """ (str) ADMITTED if the request ran, otherwise the reason it was shed """
+        requester = self._requesters.get(request_type)
+        if requester is None:
+            self._unknown += 1
+            return UNKNOWN_REQUESTER
+        return requester.request(user, command)
+
+    def get_load_stats(self):
+        """ (Dict<str, Dict<str, int>>) Each requester's load stats, with the sums under 'total' """
+        result = {name: requester.get_load_stats() for name, requester in self._requesters.items()}
+        total = {UNKNOWN_REQUESTER: self._unknown} if self._unknown else {}
+        for stats in list(result.values()):
+            for reason, count in stats.items():
+                total[reason] = total.get(reason, 0) + count
+        result['total'] = total
+        return result
 
 
 def test_images():
@@ -142,15 +981,32 @@ def test_images():
     print(res)
     print(model.get_requests())
 
+def test_prompts():
+    model = ImageRequester()
+
+    model.request('harry', 'a giant red dragon')
+    model.request('troll', 'A giant, red  dragon!')
+    model.request('keats', 'a giant red dargon') # swapped letters
+    model.request('chat', 'a giant red drgon') # missing letter
+    model.request('mod', 'a giant blue whale')
+
+    requests = model.get_requests()
+    assert requests == {'a giant red dragon': {'harry', 'troll', 'keats', 'chat'},
+                        'a giant blue whale': {'mod'}}, requests
+    print(requests)
+
 def test_sounds():
     sounds = SoundRequester(sound_file='sounds/soundfile', sound_folder='sounds')
     sounds.request('harry', 'dickhead')
     sounds.request('haa', 'raw2')
+    sounds.close()
 
 def main():
     test_sounds()
     print('x')
-    winsound.PlaySound(os.path.join(os.getcwd(), 'sounds', 'stop.wav'), winsound.SND_FILENAME)
+    player = SoundPlayer()
+    player.play(Sound.from_file('stop', os.path.join(os.getcwd(), 'sounds', 'stop.wav')))
+    player.close()
     
 
    